@@ -0,0 +1,231 @@
+# !/usr/bin/env Python3
+# -*- coding: utf-8 -*-
+# @Author   : zhangzhanqi
+# @FILE     : admission.py
+# @Time     : 2023/11/29 9:37
+import asyncio
+import contextlib
+import heapq
+import itertools
+import math
+import re
+import time
+from typing import Any, AsyncIterator, Callable, Dict, List, Mapping, Optional, Sequence, Tuple
+
+from fastapi import APIRouter, HTTPException, status
+from fastapi.responses import JSONResponse
+
+from .responses import DataResponse, GenericData
+
+
+class AdmissionClass:
+    """
+    A class of routes of an `AdmissionController`: the lower `priority` is admitted first, at most `limit`
+    requests of the class are in flight, at most `max_queue` wait, each at most `budget` seconds.
+    """
+
+    def __init__(self, priority: int = 10, limit: Optional[int] = None, max_queue: int = 100, budget: float = 1.0):
+        self.priority = priority
+        self.limit = limit
+        self.max_queue = max_queue
+        self.budget = budget
+        self.in_flight = 0
+        self.queued = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.wait_total = 0.0
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "priority": self.priority, "limit": self.limit, "in_flight": self.in_flight, "queued": self.queued,
+            "admitted": self.admitted, "rejected": self.rejected,
+            "wait_avg": self.wait_total / self.admitted if self.admitted else 0.0,
+        }
+
+
+class AdmissionController:
+    """
+    Admission control in front of the connection pool of a database: at most `limit` requests run at once,
+    the capacity of the pool by default, the others wait by priority of their `AdmissionClass`. A request is
+    refused at once with a 503 when its wait would exceed the `budget` of its class, estimated from the time
+    the requests hold their slot, or when it waited that long; with a 429 when the queue of its class is full.
+    Both carry a `Retry-After`. The routes are classified by the first of the `routes` regexes their path
+    matches, `default` otherwise:
+
+        ```Python
+        admission = AdmissionController(db, classes={
+            "auth": AdmissionClass(priority=0),
+            "export": AdmissionClass(priority=20, limit=2, max_queue=10, budget=5),
+        }, routes=[(r"^/auth/", "auth"), (r"/export/", "export")])
+        app.add_middleware(db.asgi_middleware)
+        app.add_middleware(admission.asgi_middleware)  # outside of the session middleware
+        ```
+    """
+
+    def __init__(
+            self,
+            db: Any = None,
+            limit: Optional[int] = None,
+            classes: Optional[Mapping[str, AdmissionClass]] = None,
+            routes: Sequence[Tuple[str, str]] = (),
+            classify: Optional[Callable[[Dict[str, Any]], Optional[str]]] = None,
+    ):
+        self.db = db
+        self.limit = limit or self._pool_capacity(db)
+        self.classes: Dict[str, AdmissionClass] = {"default": AdmissionClass(), **(classes or {})}
+        self.routes = [(re.compile(pattern), name) for pattern, name in routes]
+        self.classify = classify or self._classify
+        """The class of the ASGI scope of a request, `None` for a request which is not admitted, such as
+        the routes of static files."""
+        self.in_flight = 0
+        self.hold_time: Optional[float] = None
+        """The moving average of the seconds a request holds its slot."""
+        self._waiters: List[Tuple[int, int, str, asyncio.Future]] = []
+        self._counter = itertools.count()
+
+    @staticmethod
+    def _pool_capacity(db: Any) -> int:
+        pool = getattr(getattr(db, "engine", None), "pool", None)
+        size = getattr(pool, "size", None)
+        if not callable(size):  # NullPool, StaticPool
+            return 10
+        return size() + max(getattr(pool, "_max_overflow", 0), 0)
+
+    def _classify(self, scope: Dict[str, Any]) -> Optional[str]:
+        path = scope.get("path", "")
+        for pattern, name in self.routes:
+            if pattern.search(path):
+                return name
+        return "default"
+
+    def _runnable(self, cls: AdmissionClass) -> bool:
+        return self.in_flight < self.limit and (cls.limit is None or cls.in_flight < cls.limit)
+
+    def _retry_after(self, seconds: float) -> Dict[str, str]:
+        return {"Retry-After": str(max(1, math.ceil(seconds)))}
+
+    def _refuse(self, cls: AdmissionClass, status_code: int, seconds: float) -> HTTPException:
+        cls.rejected += 1
+        detail = "Too many requests" if status_code == status.HTTP_429_TOO_MANY_REQUESTS else "Service overloaded"
+        return HTTPException(status_code=status_code, detail=detail, headers=self._retry_after(seconds))
+
+    def _estimate_wait(self, cls: AdmissionClass) -> Optional[float]:
+        """The seconds before the slot of a new request of `cls`, from the requests waiting before it."""
+        if self.hold_time is None:
+            return None
+        ahead = sum(1 for priority, *_ in self._waiters if priority <= cls.priority)
+        limit = self.limit if cls.limit is None else min(self.limit, cls.limit)
+        return (ahead + 1) * self.hold_time / limit
+
+    @contextlib.asynccontextmanager
+    async def admit(self, name: str = "default") -> AsyncIterator[None]:
+        """Hold a slot of the class `name` for the block, raises the `HTTPException` of a refused request."""
+        cls = self.classes.get(name) or self.classes["default"]
+        started = time.monotonic()
+        if not (self._runnable(cls) and not self._waiters):
+            if cls.queued >= cls.max_queue:
+                raise self._refuse(cls, status.HTTP_429_TOO_MANY_REQUESTS, self._estimate_wait(cls) or cls.budget)
+            estimate = self._estimate_wait(cls)
+            if estimate is not None and estimate > cls.budget:
+                raise self._refuse(cls, status.HTTP_503_SERVICE_UNAVAILABLE, estimate)
+            future = asyncio.get_running_loop().create_future()
+            waiter = (cls.priority, next(self._counter), name, future)
+            heapq.heappush(self._waiters, waiter)
+            cls.queued += 1
+            # A waiter of a class at its limit does not hold back the requests of the other classes.
+            self._dispatch()
+            try:
+                await asyncio.wait_for(asyncio.shield(future), cls.budget)
+            except asyncio.TimeoutError:
+                if not future.done():
+                    cls.queued -= 1
+                    self._waiters.remove(waiter)
+                    heapq.heapify(self._waiters)
+                    raise self._refuse(cls, status.HTTP_503_SERVICE_UNAVAILABLE, self._estimate_wait(cls) or cls.budget)
+            except asyncio.CancelledError:
+                if future.done():  # Admitted meanwhile, the slot goes to the next one.
+                    self._release(cls, time.monotonic())
+                else:
+                    cls.queued -= 1
+                    self._waiters.remove(waiter)
+                    heapq.heapify(self._waiters)
+                raise
+        else:
+            self._acquire(cls)
+        cls.admitted += 1
+        cls.wait_total += time.monotonic() - started
+        acquired = time.monotonic()
+        try:
+            yield
+        finally:
+            self._release(cls, acquired)
+
+    def _acquire(self, cls: AdmissionClass) -> None:
+        self.in_flight += 1
+        cls.in_flight += 1
+
+    def _release(self, cls: AdmissionClass, acquired: float) -> None:
+        self.in_flight -= 1
+        cls.in_flight -= 1
+        held = time.monotonic() - acquired
+        self.hold_time = held if self.hold_time is None else 0.8 * self.hold_time + 0.2 * held
+        self._dispatch()
+
+    def _dispatch(self) -> None:
+        """Admit the waiters by priority, a waiter of a class at its limit lets the next ones through."""
+        blocked = []
+        while self._waiters and self.in_flight < self.limit:
+            waiter = heapq.heappop(self._waiters)
+            cls = self.classes.get(waiter[2]) or self.classes["default"]
+            if not self._runnable(cls):
+                blocked.append(waiter)
+                continue
+            cls.queued -= 1
+            self._acquire(cls)
+            waiter[3].set_result(None)
+        for waiter in blocked:
+            heapq.heappush(self._waiters, waiter)
+
+    def stats(self) -> Dict[str, Any]:
+        """The depth of the queues and the counters of the classes."""
+        pool = getattr(getattr(self.db, "engine", None), "pool", None)
+        checked_out = getattr(pool, "checkedout", None)
+        return {
+            "limit": self.limit, "in_flight": self.in_flight, "queued": len(self._waiters),
+            "hold_time": self.hold_time, "pool_checked_out": checked_out() if callable(checked_out) else None,
+            "classes": {name: cls.stats() for name, cls in self.classes.items()},
+        }
+
+    def router(self, path: str = "/admission", dependencies: Optional[Sequence[Any]] = None) -> APIRouter:
+        """A route of `stats`, guarded by `dependencies`."""
+        router = APIRouter(dependencies=dependencies)
+
+        @router.get(path, response_model=GenericData[Dict[str, Any]], name="admission stats")
+        async def __admission_stats():
+            return DataResponse(data=self.stats())
+
+        return router
+
+    @property
+    def asgi_middleware(self):
+        """Admit the HTTP requests before the inner middlewares and the app, a refused one gets its error at once."""
+
+        def asgi_decorator(app):
+            async def wrapped_app(scope, receive, send):
+                name = self.classify(scope) if scope["type"] == "http" else None
+                if name is None:
+                    return await app(scope, receive, send)
+                admitted = False
+                try:
+                    async with self.admit(name):
+                        admitted = True
+                        await app(scope, receive, send)
+                except HTTPException as exc:
+                    if admitted:
+                        raise
+                    response = JSONResponse({"detail": exc.detail}, status_code=exc.status_code, headers=exc.headers)
+                    await response(scope, receive, send)
+
+            return wrapped_app
+
+        return asgi_decorator
@@ -0,0 +1,128 @@
+# !/usr/bin/env Python3
+# -*- coding: utf-8 -*-
+# @Author   : zhangzhanqi
+# @FILE     : cache.py
+# @Time     : 2023/11/20 10:26
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional, Tuple, Callable, Dict
+
+_MISSING = object()
+
+
+class TTLCache:
+    """A bounded in-process cache, the least recently used entry is evicted first
+    and every entry expires `ttl` seconds after it was set."""
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return default
+        expires, value = item
+        if expires < time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def peek(self, key: Hashable, default: Any = None) -> Any:
+        """The value of `key` without counting a hit or a miss nor refreshing its recency."""
+        item = self._data.get(key)
+        if item is None or item[0] < time.monotonic():
+            return default
+        return item[1]
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        item = self._data.pop(key, None)
+        return default if item is None else item[1]
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {"size": len(self._data), "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+    def __contains__(self, key: Hashable) -> bool:
+        item = self._data.get(key)
+        return item is not None and item[0] >= time.monotonic()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class TieredCache:
+    """
+    A `TTLCache` in front of an optional shared tier, any client with the async `get/set/delete`
+    of `redis.asyncio.Redis`. The shared tier stores `dumps(value)` under `prefix + str(key)`,
+    a hit there is loaded into the local tier.
+    """
+
+    def __init__(
+            self,
+            maxsize: int = 1024,
+            ttl: float = 60,
+            redis: Any = None,
+            prefix: str = "",
+            dumps: Callable[[Any], bytes] = None,
+            loads: Callable[[bytes], Any] = None,
+    ):
+        self.local = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.redis = redis
+        assert redis is None or (dumps and loads), "dumps and loads are required by the shared tier"
+        self.prefix = prefix
+        self.dumps = dumps
+        self.loads = loads
+        self.remote_hits = 0
+        self.remote_misses = 0
+
+    async def get(self, key: Hashable, default: Any = None) -> Any:
+        value = self.local.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+        if self.redis is None:
+            return default
+        data = await self.redis.get(self.prefix + str(key))
+        if data is None:
+            self.remote_misses += 1
+            return default
+        self.remote_hits += 1
+        value = self.loads(data)
+        self.local.set(key, value)
+        return value
+
+    async def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        self.local.set(key, value, ttl)
+        if self.redis is not None:
+            ttl = self.local.ttl if ttl is None else ttl
+            await self.redis.set(self.prefix + str(key), self.dumps(value), px=max(int(ttl * 1000), 1))
+
+    async def delete(self, *keys: Hashable) -> None:
+        for key in keys:
+            self.local.pop(key)
+        if self.redis is not None and keys:
+            await self.redis.delete(*[self.prefix + str(key) for key in keys])
+
+    def clear(self) -> None:
+        """Only the local tier, the keys of the shared tier expire by themselves."""
+        self.local.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {**self.local.stats(), "remote_hits": self.remote_hits, "remote_misses": self.remote_misses}
@@ -0,0 +1,174 @@
+# !/usr/bin/env Python3
+# -*- coding: utf-8 -*-
+# @Author   : zhangzhanqi
+# @FILE     : queue.py
+# @Time     : 2023/11/27 10:12
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class _Put:
+    """The future of a waiting `put`, resolved once all of its items were flushed, over as many batches."""
+
+    def __init__(self, future: asyncio.Future, size: int):
+        self.future = future
+        self.results: List[Any] = [None] * size
+        self.remaining = size
+        self.error: Optional[BaseException] = None
+
+    def done(self, indexes: Sequence[int], results: Optional[Sequence[Any]] = None,
+             error: Optional[BaseException] = None) -> None:
+        if results is not None:
+            for index, result in zip(indexes, results):
+                self.results[index] = result
+        if error is not None and self.error is None:
+            self.error = error
+        self.remaining -= len(indexes)
+        if self.remaining or self.future.done():
+            return
+        if self.error is not None:
+            self.future.set_exception(self.error)
+        else:
+            self.future.set_result(self.results)
+
+
+class WriteBehindQueue:
+    """A bounded queue coalescing the items of many small writes into batches, `flush` is awaited with
+    up to `batch_size` items once `batch_size` items are queued or `interval` seconds after the first one.
+
+    `put` waits for the queue to have room for all of its items, at most `put_timeout` seconds before it
+    raises `asyncio.QueueFull`; with `wait=True` it also waits for the flush of its items and returns their
+    results, once the last of its batches was flushed; it raises the error of any of them. A failed batch of
+    several puts is flushed again put by put, so a bad item only fails its own put.
+    """
+
+    def __init__(
+            self,
+            flush: Callable[[List[Any]], Awaitable[List[Any]]],
+            maxsize: int = 10000,
+            batch_size: int = 500,
+            interval: float = 0.05,
+            put_timeout: Optional[float] = None,
+    ):
+        self.flush_items = flush
+        self.maxsize = maxsize
+        self.batch_size = batch_size
+        self.interval = interval
+        self.put_timeout = put_timeout
+        self._items: Deque[Tuple[Any, Optional[_Put], int]] = deque()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._worker: Optional[asyncio.Task] = None
+        self.flushes = 0
+        self.flushed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.flush_latency = 0.0
+        self.flush_latency_max = 0.0
+        self._flush_latency_total = 0.0
+
+    def _start(self) -> None:
+        # The primitives belong to the loop of the first put, a new loop (a restarted app) starts over.
+        loop = asyncio.get_running_loop()
+        if self._loop is loop and self._worker is not None and not self._worker.done():
+            return
+        self._loop = loop
+        self._items.clear()
+        self._not_full = asyncio.Condition()
+        self._not_empty = asyncio.Event()
+        self._full = asyncio.Event()
+        self._worker = loop.create_task(self._run())
+
+    async def put(self, items: Sequence[Any], wait: bool = True) -> Optional[List[Any]]:
+        self._start()
+        put = _Put(self._loop.create_future(), len(items)) if wait else None
+        async with self._not_full:
+            # An empty queue takes a put larger than `maxsize`, it would never fit otherwise.
+            room = lambda: not self._items or len(self._items) + len(items) <= self.maxsize  # noqa: E731
+            try:
+                await asyncio.wait_for(self._not_full.wait_for(room), self.put_timeout)
+            except asyncio.TimeoutError:
+                self.rejected += len(items)
+                raise asyncio.QueueFull()
+            self._items.extend((item, put, index) for index, item in enumerate(items))
+        self._not_empty.set()
+        if len(self._items) >= self.batch_size:
+            self._full.set()
+        return await put.future if put is not None else None
+
+    async def _run(self) -> None:
+        while True:
+            await self._not_empty.wait()
+            try:
+                await asyncio.wait_for(self._full.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            await self._flush_batch()
+
+    async def _flush_batch(self) -> None:
+        batch = [self._items.popleft() for _ in range(min(self.batch_size, len(self._items)))]
+        if not self._items:
+            self._not_empty.clear()
+        if len(self._items) < self.batch_size:
+            self._full.clear()
+        async with self._not_full:
+            self._not_full.notify_all()
+        if not batch:
+            return
+        started = time.monotonic()
+        try:
+            await self._flush(batch)
+        finally:
+            self.flushes += 1
+            self.flush_latency = time.monotonic() - started
+            self.flush_latency_max = max(self.flush_latency_max, self.flush_latency)
+            self._flush_latency_total += self.flush_latency
+
+    async def _flush(self, batch: List[Tuple[Any, Optional[_Put], int]]) -> None:
+        puts: Dict[Optional[_Put], List[Tuple[Any, Optional[_Put], int]]] = {}
+        for entry in batch:
+            puts.setdefault(entry[1], []).append(entry)
+        batch = [entry for entries in puts.values() for entry in entries]
+        try:
+            results = await self.flush_items([item for item, _, _ in batch])
+        except Exception as exc:
+            if len(puts) > 1:
+                for entries in puts.values():
+                    await self._flush(entries)
+                return
+            self.failed += len(batch)
+            put = batch[0][1]
+            if put is None:
+                logger.exception("Write-behind flush of %d items failed", len(batch))
+            else:
+                put.done([index for _, _, index in batch], error=exc)
+            return
+        self.flushed += len(batch)
+        offset = 0
+        for put, entries in puts.items():
+            if put is not None:
+                put.done([index for _, _, index in entries], results[offset:offset + len(entries)])
+            offset += len(entries)
+
+    async def flush(self) -> None:
+        """Flush the queued items now, at the shutdown of the app for example."""
+        while self._items:
+            await self._flush_batch()
+
+    async def close(self) -> None:
+        await self.flush()
+        if self._worker is not None:
+            self._worker.cancel()
+            self._worker = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "depth": len(self._items), "maxsize": self.maxsize, "flushes": self.flushes, "flushed": self.flushed,
+            "failed": self.failed, "rejected": self.rejected, "flush_latency": self.flush_latency,
+            "flush_latency_max": self.flush_latency_max,
+            "flush_latency_avg": self._flush_latency_total / self.flushes if self.flushes else 0.0,
+        }
@@ -7,6 +7,7 @@ from typing import Any, Dict, Optional, Generic, TypeVar
 
 from fastapi.responses import JSONResponse
 from pydantic import BaseModel
+from pydantic_core import to_json
 
 Data = TypeVar('Data')
 
@@ -34,20 +35,18 @@ class DataResponse(JSONResponse):
                          content=content)
 
     def render(self, content: Any) -> bytes:
-        if isinstance(content, Dict):
-            content.update({"code": self.status_code})
-            return GenericData(**content).model_dump_json(
-                exclude_none=self.exclude_none,
-                by_alias=True,
-            ).encode("utf-8")
-        elif isinstance(content, GenericData):
+        if isinstance(content, GenericData):
             content.code = self.status_code
             return content.model_dump_json(
                 exclude_none=self.exclude_none,
                 by_alias=True,
             ).encode("utf-8")
-        else:
-            return GenericData(code=self.status_code, data=content).model_dump_json(
-                exclude_none=self.exclude_none,
-                by_alias=True,
-            ).encode('utf-8')
+        if not isinstance(content, Dict):
+            content = {"data": content}
+        content.update({"code": self.status_code})
+        # Serialize the envelope in one pass, the data is already validated and is not
+        # validated again into a `GenericData`.
+        envelope = {name: content.get(name, field.default) for name, field in GenericData.model_fields.items()}
+        if self.exclude_none:
+            envelope = {name: value for name, value in envelope.items() if value is not None}
+        return to_json(envelope, exclude_none=self.exclude_none, by_alias=True)
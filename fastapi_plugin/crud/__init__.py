@@ -4,5 +4,7 @@
 # @FILE     : __init__.py.py
 # @Time     : 2023/10/11 15:47
 from ._sqlalchemy import SqlalchemyDatabase, SQLAlchemyCrud
+from ._sharded import ShardedSQLAlchemyCrud as ShardedSQLAlchemyCrud
 from .sqlmodel import SQLModel, Field
+from .router import batch_router as batch_router
 from .utils import get_engine_db as get_engine_db
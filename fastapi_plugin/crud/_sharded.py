@@ -0,0 +1,319 @@
+# !/usr/bin/env Python3
+# -*- coding: utf-8 -*-
+# @Author   : zhangzhanqi
+# @FILE     : _sharded.py
+# @Time     : 2023/11/28 14:20
+import asyncio
+import copy
+import functools
+import heapq
+import time
+from typing import Any, Callable, Dict, Hashable, List, Mapping, Optional, Sequence, Tuple, Type, Union, \
+    Iterator, AsyncIterator, Literal
+
+from fastapi import HTTPException, status
+from fastapi.requests import Request
+from pydantic import BaseModel
+
+from ._sqlalchemy import SQLAlchemyCrud, TableModel
+from .parser import Selector, Paginator, encode_cursor
+from .sqlmodel import LoaderStrategy
+from .utils import SqlalchemyDatabase
+
+_MERGE_AGGREGATES = {"count": sum, "sum": sum, "min": min, "max": max}
+
+
+def _compare(a: Sequence[Any], b: Sequence[Any], descending: Sequence[bool]) -> int:
+    """Compare two sort keys, `None` sorts first ascending and last descending, as `NULL` of the keyset order."""
+    for x, y, desc in zip(a, b, descending):
+        if x == y:
+            continue
+        result = -1 if x is None or (y is not None and x < y) else 1
+        return -result if desc else result
+    return 0
+
+
+def _sort_key(keyset: List[Tuple[str, bool]]) -> Callable[[Any], Any]:
+    names, descending = [name for name, _ in keyset], [desc for _, desc in keyset]
+    return functools.cmp_to_key(lambda a, b: _compare(
+        [getattr(a, name) for name in names], [getattr(b, name) for name in names], descending
+    ))
+
+
+class ShardedSQLAlchemyCrud(SQLAlchemyCrud[TableModel]):
+    """
+    A crud of a model partitioned across databases. `shard_key` maps a primary key to the key of its
+    database in `shards`, every shard has a `shard_crud_class` crud built with the same keyword arguments.
+
+    An operation on primary keys runs on their shards only, concurrently when there are several.
+    `read_items` reads the page from every shard concurrently, ordered by the keyset of the paginator,
+    and merges the sorted pages: a page of offset paging reads `page * page_size` rows per shard, cursor
+    paging reads `page_size` rows per shard after the cursor. The primary key of a created item must be known
+    before the insert (a `default_factory` such as `uuid4`), an autoincrement would collide across shards.
+
+    The writes of a request are committed per shard, by the middleware of each shard database:
+
+        ```Python
+        for db in crud.databases():
+            app.add_middleware(db.asgi_middleware)
+        ```
+    """
+
+    def __init__(
+            self,
+            model: Type[TableModel],
+            shards: Mapping[Hashable, SqlalchemyDatabase],
+            shard_key: Callable[[Any], Hashable],
+            shard_crud_class: Type[SQLAlchemyCrud] = SQLAlchemyCrud,
+            **kwargs,
+    ):
+        assert shards, "shards is empty"
+        self.shards: Dict[Hashable, SQLAlchemyCrud] = {
+            key: shard_crud_class(model, engine, **kwargs) for key, engine in shards.items()
+        }
+        """The crud of each shard, by shard key."""
+        self.shard_key = shard_key
+        # `db` is the database of the first shard, the operations of this crud never use it.
+        super().__init__(model, next(iter(self.shards.values())).db, **kwargs)
+        # The shards return instances of the schema models of this crud, the routes validate them as such.
+        for crud in self.shards.values():
+            crud.CreateModel, crud.ReadModel = self.CreateModel, self.ReadModel
+            crud.UpdateModel, crud.DeleteModel = self.UpdateModel, self.DeleteModel
+            crud.UpsertModel = self.UpsertModel
+            crud._projection_models = self._projection_models
+
+    def databases(self) -> list:
+        return [crud.db for crud in self.shards.values()]
+
+    def shard(self, primary_key: Any) -> SQLAlchemyCrud:
+        return self.shards[self.shard_key(primary_key)]
+
+    def _group(self, primary_key: Sequence[Any]) -> Dict[Hashable, List[int]]:
+        """The indexes of the primary keys by shard key, in the order of `primary_key`,
+        keys of the type of the primary key field, see `parse_primary_key`."""
+        groups: Dict[Hashable, List[int]] = {}
+        for index, pk in enumerate(primary_key):
+            if pk is None:
+                raise HTTPException(
+                    status_code=status.HTTP_400_BAD_REQUEST, detail="The primary key of a sharded item is required"
+                )
+            groups.setdefault(self.shard_key(pk), []).append(index)
+        return groups
+
+    async def _scatter(
+            self, primary_key: Sequence[Any], call: Callable[[SQLAlchemyCrud, List[int]], Any], ordered: bool = False
+    ) -> list:
+        """
+        Await `call` on the shard of each group of primary keys concurrently, the results are concatenated.
+        `ordered` results, one per primary key, are returned in the order of `primary_key`.
+        """
+        groups = self._group(primary_key)
+        results = await asyncio.gather(*[call(self.shards[key], indexes) for key, indexes in groups.items()])
+        if ordered and all(len(objs) == len(indexes) for objs, indexes in zip(results, groups.values())):
+            positions = [index for indexes in groups.values() for index in indexes]
+            return [obj for _, obj in sorted(zip(positions, [obj for objs in results for obj in objs]),
+                                             key=lambda pair: pair[0])]
+        return [obj for objs in results for obj in objs]
+
+    def use_replica(self, enabled: bool = True) -> None:
+        for crud in self.shards.values():
+            crud.use_replica(enabled)
+
+    async def create_items(
+            self,
+            request: Request,
+            items: List[TableModel],
+            bulk: Optional[bool] = None,
+            write_behind: Optional[bool] = None,
+    ) -> List[TableModel]:
+        objs = [self.create_item(item) for item in items]
+        return await self._scatter(
+            [getattr(obj, self.pk_name) for obj in objs],
+            lambda crud, indexes: crud.create_items(request, [objs[i] for i in indexes], bulk, write_behind),
+            ordered=True,
+        )
+
+    async def read_item_by_primary_key(
+            self,
+            request: Request,
+            primary_key: Any,
+            fields: Optional[Sequence[str]] = None,
+            loaders: Optional[Dict[str, LoaderStrategy]] = None,
+    ) -> TableModel:
+        return await self.shard(primary_key).read_item_by_primary_key(request, primary_key, fields, loaders)
+
+    async def read_items_by_primary_key(
+            self,
+            request: Request,
+            primary_key: List[Any],
+            fields: Optional[Sequence[str]] = None,
+            loaders: Optional[Dict[str, LoaderStrategy]] = None,
+    ) -> List[TableModel]:
+        primary_key = self.parse_primary_key(primary_key)
+        return await self._scatter(primary_key, lambda crud, indexes: crud.read_items_by_primary_key(
+            request, [primary_key[i] for i in indexes], fields, loaders
+        ))
+
+    async def invalidate_items(self, primary_key: Sequence[Any]) -> None:
+        primary_key = self.parse_primary_key(primary_key)
+        await self._scatter(primary_key, lambda crud, indexes: self._invalidate_shard(
+            crud, [primary_key[i] for i in indexes]
+        ))
+
+    @staticmethod
+    async def _invalidate_shard(crud: SQLAlchemyCrud, primary_key: List[Any]) -> list:
+        await crud.invalidate_items(primary_key)
+        return []
+
+    async def read_item_etag(self, primary_key: Any, fields: Optional[Sequence[str]] = None) -> Optional[str]:
+        return await self.shard(primary_key).read_item_etag(primary_key, fields)
+
+    async def read_items(
+            self,
+            request: Request,
+            selector: Selector,
+            paginator: Paginator,
+            fields: Optional[Sequence[str]] = None,
+            loaders: Optional[Dict[str, LoaderStrategy]] = None,
+    ) -> Tuple[List[TableModel], int]:
+        """Read the page from every shard concurrently and merge the pages sorted by the keyset."""
+        started = time.monotonic()
+        keyset = paginator.calc_keyset_ordering(self.Model, self.pk_name)
+        ordering = [f"-{name}" if descending else name for name, descending in keyset]
+        # Every shard orders by the complete keyset, and loads its fields, for the merge.
+        shard_fields = list(dict.fromkeys([*fields, *[name for name, _ in keyset]])) if fields else None
+        shard_paginators = []
+        for _ in self.shards:
+            shard_paginator = copy.copy(paginator)
+            if not paginator.cursor_mode:
+                shard_paginator.order_by = ordering
+                shard_paginator.page, shard_paginator.page_size = 1, paginator.page * paginator.page_size
+            shard_paginators.append(shard_paginator)
+        pages = await asyncio.gather(*[
+            crud.read_items(request, selector, shard_paginator, shard_fields, loaders)
+            for crud, shard_paginator in zip(self.shards.values(), shard_paginators)
+        ])
+        merged = list(heapq.merge(*[objs for objs, _ in pages], key=_sort_key(keyset)))
+        if paginator.cursor_mode:
+            has_next = len(merged) > paginator.page_size or any(p.next_cursor for p in shard_paginators)
+            results = merged[:paginator.page_size]
+            paginator.next_cursor = None
+            if has_next and results:
+                paginator.next_cursor = encode_cursor(ordering, [getattr(results[-1], name) for name, _ in keyset])
+        else:
+            results = merged[(paginator.page - 1) * paginator.page_size:paginator.page * paginator.page_size]
+        totals = [total for _, total in pages]
+        paginator.total_strategy = shard_paginators[0].total_strategy
+        total = -1 if -1 in totals else sum(totals)
+        if fields and shard_fields != list(fields):
+            results = self.read_models(results, self.projection_model(fields))
+        if self.usage is not None:
+            self.record_usage(selector, paginator, time.monotonic() - started)
+        return results, total
+
+    async def explain_items(
+            self,
+            selector: Selector,
+            paginator: Paginator,
+            fields: Optional[Sequence[str]] = None,
+            loaders: Optional[Dict[str, LoaderStrategy]] = None,
+    ) -> Dict[str, Any]:
+        """The plans of every shard, by shard key, for the page of the paginator."""
+        plans = await asyncio.gather(*[crud.explain_items(selector, paginator, fields, loaders)
+                                       for crud in self.shards.values()])
+        return {"shards": {str(key): plan for key, plan in zip(self.shards, plans)}}
+
+    async def upsert_items(
+            self, request: Request, items: List[BaseModel], conflict: Optional[Sequence[str]] = None
+    ) -> List[BaseModel]:
+        return await self._scatter(
+            [getattr(item, self.pk_name, None) for item in items],
+            lambda crud, indexes: crud.upsert_items(request, [items[i] for i in indexes], conflict),
+            ordered=True,
+        )
+
+    async def update_items(
+            self,
+            request: Request,
+            primary_key: List[Any],
+            item: TableModel,
+            bulk: Optional[bool] = None,
+            query=None,
+    ) -> List[TableModel]:
+        primary_key = self.parse_primary_key(primary_key)
+        return await self._scatter(primary_key, lambda crud, indexes: crud.update_items(
+            request, [primary_key[i] for i in indexes], item, bulk, query
+        ))
+
+    async def delete_items(
+            self, request: Request, primary_key: List[Any], bulk: Optional[bool] = None, query=None
+    ) -> List[TableModel]:
+        primary_key = self.parse_primary_key(primary_key)
+        return await self._scatter(primary_key, lambda crud, indexes: crud.delete_items(
+            request, [primary_key[i] for i in indexes], bulk, query
+        ))
+
+    async def aggregate_items(
+            self,
+            request: Request,
+            selector: Selector,
+            group_by: Sequence[str] = (),
+            aggregates: Sequence[str] = ("count",),
+            limit: int = 1000,
+    ) -> Tuple[List[str], List[List[Any]]]:
+        """Aggregate on every shard and merge the groups, `avg` can not be merged from the shard results."""
+        functions = [spec.partition(":")[0] for spec in aggregates]
+        if "avg" in functions:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="avg is not supported on shards")
+        # A group may be beyond the limit of a shard and within the merged limit, the shards are not limited.
+        results = await asyncio.gather(*[
+            crud.aggregate_items(request, selector, group_by, aggregates, limit=None) for crud in self.shards.values()
+        ])
+        columns = results[0][0]
+        width = len(group_by)
+        groups: Dict[tuple, List[List[Any]]] = {}
+        for _, rows in results:
+            for row in rows:
+                groups.setdefault(tuple(row[:width]), []).append(row[width:])
+        key = functools.cmp_to_key(lambda a, b: _compare(a, b, [False] * width))
+        rows = []
+        for group in sorted(groups, key=key)[:limit]:
+            values = [
+                _MERGE_AGGREGATES[function](value for value in values if value is not None)
+                if any(value is not None for value in values) else None
+                for function, values in zip(functions, zip(*groups[group]))
+            ]
+            rows.append([*group, *values])
+        return columns, rows
+
+    def export_items(
+            self,
+            selector: Selector,
+            order_by: Sequence[str] = (),
+            fields: Optional[Sequence[str]] = None,
+            format: Literal["ndjson", "csv"] = "ndjson",
+            batch_size: int = 1000,
+    ) -> Union[Iterator[bytes], AsyncIterator[bytes]]:
+        """Stream the shards one after the other, `order_by` orders the rows of each shard."""
+        exports = [crud.export_items(selector, order_by, fields, format, batch_size) for crud in self.shards.values()]
+        if hasattr(exports[0], "__aiter__"):
+            return self._chain_async(exports, format == "csv")
+        return self._chain_sync(exports, format == "csv")
+
+    @staticmethod
+    async def _chain_async(exports: list, head: bool):
+        for i, export in enumerate(exports):
+            first = True
+            async for chunk in export:
+                # The first chunk of a CSV export is its header.
+                if not (head and first and i):
+                    yield chunk
+                first = False
+
+    @staticmethod
+    def _chain_sync(exports: list, head: bool):
+        for i, export in enumerate(exports):
+            for j, chunk in enumerate(export):
+                if not (head and j == 0 and i):
+                    yield chunk
+
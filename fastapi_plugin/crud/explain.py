@@ -0,0 +1,36 @@
+# !/usr/bin/env Python3
+# -*- coding: utf-8 -*-
+# @Author   : zhangzhanqi
+# @FILE     : explain.py
+# @Time     : 2023/11/20 10:41
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import ClauseElement, Executable
+
+
+class Explain(Executable, ClauseElement):
+    """`EXPLAIN` of a statement in the plan format of the dialect, executed like any other statement:
+
+        ```Python
+        plan = session.execute(Explain(select(User).where(User.id > 10))).all()
+        ```
+    """
+
+    inherit_cache = False
+
+    def __init__(self, statement: Executable):
+        self.statement = statement
+
+
+@compiles(Explain)
+def _explain(element: Explain, compiler, **kw) -> str:
+    return f"EXPLAIN {compiler.process(element.statement, **kw)}"
+
+
+@compiles(Explain, "postgresql")
+def _explain_postgresql(element: Explain, compiler, **kw) -> str:
+    return f"EXPLAIN (FORMAT JSON) {compiler.process(element.statement, **kw)}"
+
+
+@compiles(Explain, "sqlite")
+def _explain_sqlite(element: Explain, compiler, **kw) -> str:
+    return f"EXPLAIN QUERY PLAN {compiler.process(element.statement, **kw)}"
@@ -0,0 +1,259 @@
+# !/usr/bin/env Python3
+# -*- coding: utf-8 -*-
+# @Author   : zhangzhanqi
+# @FILE     : functions.py
+# @Time     : 2023/11/24 15:02
+import json
+import re
+from typing import Any, Literal, Sequence, get_args
+
+from sqlalchemy import Boolean, String, Table, any_, bindparam, event, func, literal, literal_column, not_
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.functions import FunctionElement
+from sqlalchemy.types import TypeDecorator
+
+TimeUnit = Literal["minute", "hour", "day", "week", "month", "year"]
+TIME_UNITS = get_args(TimeUnit)
+
+
+class DateBucket(FunctionElement):
+    """The start of the `unit` period of a datetime column, the time bucket of a `GROUP BY`:
+
+        ```Python
+        bucket = DateBucket("day", Article.create_time)
+        session.execute(select(bucket, func.count()).group_by(bucket)).all()
+        ```
+    """
+
+    name = "date_bucket"
+    inherit_cache = False
+
+    def __init__(self, unit: TimeUnit, column):
+        self.unit = unit
+        super().__init__(column)
+
+
+_SQLITE_FORMATS = {
+    "minute": "%Y-%m-%d %H:%M:00", "hour": "%Y-%m-%d %H:00:00",
+    "day": "%Y-%m-%d", "month": "%Y-%m-01", "year": "%Y-01-01",
+}
+_MYSQL_FORMATS = {
+    "minute": "%Y-%m-%d %H:%i:00", "hour": "%Y-%m-%d %H:00:00",
+    "day": "%Y-%m-%d", "month": "%Y-%m-01", "year": "%Y-01-01",
+}
+
+
+def _column(element: DateBucket):
+    return list(element.clauses)[0]
+
+
+def _constant(value: str):
+    # Rendered inline, a bound parameter would make the expression of `GROUP BY` differ from the selected one.
+    return literal_column(f"'{value}'")
+
+
+@compiles(DateBucket)
+def _date_bucket(element: DateBucket, compiler, **kw) -> str:
+    return compiler.process(func.date_trunc(_constant(element.unit), _column(element)), **kw)
+
+
+@compiles(DateBucket, "sqlite")
+def _date_bucket_sqlite(element: DateBucket, compiler, **kw) -> str:
+    column = _column(element)
+    if element.unit == "week":  # The monday of the week.
+        return compiler.process(func.date(column, _constant("weekday 0"), _constant("-6 days")), **kw)
+    return compiler.process(func.strftime(_constant(_SQLITE_FORMATS[element.unit]), column), **kw)
+
+
+@compiles(DateBucket, "mysql")
+@compiles(DateBucket, "mariadb")
+def _date_bucket_mysql(element: DateBucket, compiler, **kw) -> str:
+    column = _column(element)
+    if element.unit == "week":
+        return compiler.process(func.date(func.subdate(column, func.weekday(column))), **kw)
+    return compiler.process(func.date_format(column, _constant(_MYSQL_FORMATS[element.unit])), **kw)
+
+
+class FullTextMatch(FunctionElement):
+    """Match a `Field(full_text=True)` column against a text search query, served by the full-text index:
+
+        PostgreSQL: `to_tsvector(config, column) @@ plainto_tsquery(config, :query)`, a GIN expression index.
+        SQLite: `rowid IN (SELECT rowid FROM <table>_<column>_fts WHERE ... MATCH :query)`, a contentless FTS5 table.
+        MySQL: `MATCH (column) AGAINST (:query)`, a FULLTEXT index.
+
+    Other dialects fall back to `LIKE '%query%'`.
+    """
+
+    name = "full_text_match"
+    type = Boolean()
+    inherit_cache = True
+    _is_implicitly_boolean = True  # a predicate already, no `= 1` where booleans are not native
+
+    def __init__(self, column, query: str):
+        self.config = column.info.get("full_text") or "simple"
+        # The query of each dialect as a bound parameter, the compiled statement is cached whatever the query.
+        pattern = "%{}%".format(re.sub(r"([\\%_])", r"\\\1", query))
+        super().__init__(column, literal(query), literal(_fts5_query(query)), literal(pattern))
+
+
+def full_text_table(table: Table, column) -> str:
+    """The name of the FTS5 table indexing `column` on SQLite."""
+    return f"{table.name}_{column.name}_fts"
+
+
+def _fts5_query(query: str) -> str:
+    # Every term as an FTS5 string, the implicit AND of them, the user input is never parsed as FTS5 syntax.
+    terms = query.split()
+    return " ".join('"{}"'.format(term.replace('"', '""')) for term in terms) or '""'
+
+
+def _query(element: FullTextMatch, dialect: str):
+    return list(element.clauses)[{"sqlite": 2, "default": 3}.get(dialect, 1)]
+
+
+@compiles(FullTextMatch)
+def _full_text_match(element: FullTextMatch, compiler, **kw) -> str:
+    return compiler.process(_column(element).like(_query(element, "default"), escape="\\"), **kw)
+
+
+@compiles(FullTextMatch, "postgresql")
+def _full_text_match_postgresql(element: FullTextMatch, compiler, **kw) -> str:
+    config = _constant(element.config)
+    document = compiler.process(func.to_tsvector(config, _column(element)), **kw)
+    query = compiler.process(func.plainto_tsquery(config, _query(element, "postgresql")), **kw)
+    return f"{document} @@ {query}"
+
+
+@compiles(FullTextMatch, "sqlite")
+def _full_text_match_sqlite(element: FullTextMatch, compiler, **kw) -> str:
+    column = _column(element)
+    fts = compiler.preparer.quote(full_text_table(column.table, column))
+    query = compiler.process(_query(element, "sqlite"), **kw)
+    rowid = f"{compiler.preparer.format_table(column.table)}.rowid"
+    return f"{rowid} IN (SELECT rowid FROM {fts} WHERE {fts} MATCH {query})"
+
+
+@compiles(FullTextMatch, "mysql")
+@compiles(FullTextMatch, "mariadb")
+def _full_text_match_mysql(element: FullTextMatch, compiler, **kw) -> str:
+    column = compiler.process(_column(element), **kw)
+    query = compiler.process(_query(element, "mysql"), **kw)
+    return f"MATCH ({column}) AGAINST ({query} IN NATURAL LANGUAGE MODE)"
+
+
+def _full_text_columns(table: Table):
+    return [column for column in table.columns if column.info.get("full_text")]
+
+
+def _full_text_ddl(table: Table, column, dialect) -> list:
+    preparer = dialect.identifier_preparer
+    name, quoted = preparer.format_table(table), preparer.quote(column.name)
+    index = preparer.quote(f"ix_{table.name}_{column.name}_fts")
+    if dialect.name == "postgresql":
+        config = column.info["full_text"]
+        if not re.fullmatch(r"[\w.]+", config):
+            raise ValueError(f"Invalid text search configuration: {config}")
+        return [f"CREATE INDEX {index} ON {name} USING gin (to_tsvector('{config}', {quoted}))"]
+    if dialect.name in ("mysql", "mariadb"):
+        return [f"CREATE FULLTEXT INDEX {index} ON {name} ({quoted})"]
+    if dialect.name != "sqlite":
+        return []
+    # SQLite keeps no copy of the text in a contentless table, the triggers maintain it on every write path of
+    # the table (ORM, bulk statements, upserts) in the transaction of the write; removing a row needs its old value.
+    fts = full_text_table(table, column)
+    fts_quoted = preparer.quote(fts)
+    insert = f"INSERT INTO {fts_quoted}(rowid, {quoted}) VALUES (new.rowid, new.{quoted});"
+    delete = (f"INSERT INTO {fts_quoted}({fts_quoted}, rowid, {quoted}) "
+              f"VALUES ('delete', old.rowid, old.{quoted});")
+    return [
+        f"CREATE VIRTUAL TABLE {fts_quoted} USING fts5({quoted}, content='')",
+        f"CREATE TRIGGER {preparer.quote(fts + '_ai')} AFTER INSERT ON {name} BEGIN {insert} END",
+        f"CREATE TRIGGER {preparer.quote(fts + '_ad')} AFTER DELETE ON {name} BEGIN {delete} END",
+        f"CREATE TRIGGER {preparer.quote(fts + '_au')} AFTER UPDATE ON {name} "
+        f"WHEN old.{quoted} IS NOT new.{quoted} OR old.rowid != new.rowid BEGIN {delete} {insert} END",
+    ]
+
+
+@event.listens_for(Table, "after_create")
+def _create_full_text_indexes(table: Table, connection, **kw):
+    for column in _full_text_columns(table):
+        for statement in _full_text_ddl(table, column, connection.dialect):
+            connection.exec_driver_sql(statement)
+
+
+@event.listens_for(Table, "after_drop")
+def _drop_full_text_indexes(table: Table, connection, **kw):
+    if connection.dialect.name != "sqlite":
+        return  # The indexes are dropped with the table.
+    preparer = connection.dialect.identifier_preparer
+    for column in _full_text_columns(table):
+        connection.exec_driver_sql(f"DROP TABLE IF EXISTS {preparer.quote(full_text_table(table, column))}")
+
+
+class _JsonArray(TypeDecorator):
+    """A list bound as one JSON array, of the values processed by the type of the items."""
+
+    impl = String
+    cache_ok = True
+
+    def __init__(self, item_type):
+        super().__init__()
+        self.item_type = item_type
+
+    def process_bind_param(self, value, dialect):
+        process = self.item_type.dialect_impl(dialect).bind_processor(dialect)
+        return json.dumps([process(item) for item in value] if process else list(value), default=str)
+
+
+class InValues(FunctionElement):
+    """`column IN (values)` as a statement of the same shape whatever the number of values:
+
+        PostgreSQL: `column = ANY(:array)`, one array parameter.
+        SQLite: `column IN (SELECT value FROM json_each(:json))`, one JSON parameter, no limit of parameters.
+
+    Other dialects expand the values into an `IN` list padded to the next power of two with the last value,
+    a list of 1000 values is one of 11 shapes.
+    """
+
+    name = "in_values"
+    type = Boolean()
+    inherit_cache = True
+    _is_implicitly_boolean = True
+
+    def __init__(self, column, values: Sequence[Any], negate: bool = False):
+        self.negate = negate
+        values = list(values)
+        item_type = column.type
+        padded = values + values[-1:] * ((1 << (len(values) - 1).bit_length()) - len(values)) if values else values
+        super().__init__(
+            column,
+            bindparam(None, values, type_=ARRAY(item_type)),
+            bindparam(None, values, type_=_JsonArray(item_type)),
+            bindparam(None, padded, type_=item_type, expanding=True),
+        )
+
+
+def in_values(column, values: Sequence[Any], negate: bool = False):
+    """`column IN (values)`, or `NOT IN` with `negate`, see `InValues`."""
+    element = InValues(column, values)
+    return not_(element) if negate else element
+
+
+@compiles(InValues)
+def _in_values(element: InValues, compiler, **kw) -> str:
+    clauses = list(element.clauses)
+    return compiler.process(clauses[0].in_(clauses[3]), **kw)
+
+
+@compiles(InValues, "postgresql")
+def _in_values_postgresql(element: InValues, compiler, **kw) -> str:
+    clauses = list(element.clauses)
+    return compiler.process(clauses[0] == any_(clauses[1]), **kw)
+
+
+@compiles(InValues, "sqlite")
+def _in_values_sqlite(element: InValues, compiler, **kw) -> str:
+    clauses = list(element.clauses)
+    column, values = compiler.process(clauses[0], **kw), compiler.process(clauses[2], **kw)
+    return f"{column} IN (SELECT value FROM json_each({values}))"
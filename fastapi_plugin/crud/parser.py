@@ -3,17 +3,46 @@
 # @Author   : zhangzhanqi
 # @FILE     : parser.py
 # @Time     : 2023/10/11 16:29
+import base64
+import copy
+import datetime
+import json
 import re
+import uuid
+from functools import lru_cache
 from re import Pattern
-from typing import Optional, Type, Union, List, Annotated, Any, Callable, Tuple, Dict
+from typing import Optional, Type, Union, List, Annotated, Any, Callable, Tuple, Dict, Literal, Sequence, \
+    get_args, get_origin
 
-from fastapi import Depends, Query
-from sqlalchemy import desc, and_
+from fastapi import Depends, Query, HTTPException, status
+from pydantic import EmailStr, SecretStr, TypeAdapter, ValidationError
+from pydantic_core import to_jsonable_python
+from sqlalchemy import desc, and_, or_, not_, inspect
 
+from .functions import FullTextMatch, in_values
 from .sqlmodel import SQLModel
 from .sqlmodel.main import FieldInfo
+from .sqlmodel.sql.sqltypes import GUID
 
-sql_operator_pattern: Pattern = re.compile(r"^\[(=|<=|<|>|>=|!|!=|<>|\*|!\*|~|!~|-)]")
+CountStrategy = Literal["exact", "window", "concurrent", "estimate", "cached"]
+"""
+How `show_total` computes the total:
+    exact: `select count(*)` of the filtered query before the page query.
+    window: `count(*) OVER ()` on the page query, a single round trip.
+    concurrent: the exact count on a second connection, concurrently with the page query.
+    estimate: the planner estimate (`pg_class.reltuples`/`EXPLAIN` rows, MySQL `EXPLAIN`, SQLite `sqlite_stat1`).
+    cached: the exact count, cached by the normalized filter for `count_cache_ttl` seconds.
+"""
+
+IndexPolicy = Literal["allow", "cap", "reject"]
+"""
+What the list route does with a read no index serves, see `SQLAlchemyCrud.unindexed_fields`:
+    allow: reads it.
+    cap: reads at most `index_cap_page_size` items, with the estimated total instead of the exact count.
+    reject: refuses it with a 400.
+"""
+
+sql_operator_pattern: Pattern = re.compile(r"^\[(=|<=|<|>|>=|!|!=|<>|\*|!\*|~|!~|-|\^|@)]")
 sql_operator_map: Dict[str, str] = {
     "=": "__eq__",
     "<=": "__le__",
@@ -28,6 +57,8 @@ sql_operator_map: Dict[str, str] = {
     "~": "like",
     "!~": "not_like",
     "-": "between",
+    "^": "startswith",  # `LIKE 'value%'`, a B-tree index can serve it
+    "@": "full_text",  # the full-text index of a `Field(full_text=True)`
 }
 
 
@@ -51,12 +82,50 @@ RequiredPrimaryKeyListDepend = Annotated[List[str], Depends(required_parser_str_
 
 
 def parser_ob_str_set_list(order_by: Optional[str] = None) -> List[str]:
-    return required_parser_str_set_list(order_by)
+    if not isinstance(order_by, str):
+        return []
+    # The order of the fields is significant, deduplicate without a set.
+    return list(dict.fromkeys(ob for ob in order_by.split(",") if ob))
 
 
 OrderByListDepend = Annotated[List[str], Depends(parser_ob_str_set_list)]
 
 
+def parser_fields_str_list(
+        fields: Optional[str] = Query(None, description="Comma separated fields of the response, all by default")
+) -> List[str]:
+    if not isinstance(fields, str):
+        return []
+    return list(dict.fromkeys(field for field in fields.split(",") if field))
+
+
+FieldsDepend = Annotated[List[str], Depends(parser_fields_str_list)]
+
+
+def encode_cursor(ordering: Sequence[str], values: Sequence[Any]) -> str:
+    """Encode the sort key of the last row of a page into an opaque, url-safe cursor."""
+    data = json.dumps([list(ordering), to_jsonable_python(list(values))], separators=(",", ":"))
+    return base64.urlsafe_b64encode(data.encode("utf-8")).rstrip(b"=").decode("ascii")
+
+
+@lru_cache(maxsize=1024)
+def get_type_adapter(annotation: Any) -> TypeAdapter:
+    return TypeAdapter(annotation)
+
+
+def decode_cursor(cursor: str, ordering: Sequence[str], annotations: Sequence[Any]) -> List[Any]:
+    """Decode a cursor produced by `encode_cursor`, it must have been built for the same ordering.
+    The values are parsed back to the python types of the ordering fields."""
+    try:
+        data = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        cursor_ordering, values = json.loads(data)
+        if cursor_ordering != list(ordering) or len(values) != len(ordering):
+            raise ValueError("cursor does not match order_by")
+        return [get_type_adapter(annotation).validate_python(value) for annotation, value in zip(annotations, values)]
+    except (ValueError, TypeError, ValidationError):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
+
+
 class Selector:
     Model: Type[SQLModel]
 
@@ -79,6 +148,12 @@ class Selector:
                     return None, None
                 if operator in ["like", "not_like"] and value.find("%") == -1:
                     return operator, (f"%{value}%",)
+                elif operator in ["like", "not_like", "full_text"]:
+                    return operator, (value,)
+                elif operator == "startswith":
+                    # A constant pattern rather than `startswith`'s `value || '%'`, the planner can range scan it.
+                    value = re.sub(r"([\\%_])", r"\\\1", value)
+                    return "like", (f"{value}%", "\\")
                 elif operator in ["in_", "not_in"]:
                     return operator, (list(map(python_type_parse, set(value.split(",")))),)
                 elif operator == "between":
@@ -89,20 +164,176 @@ class Selector:
         return operator, (python_type_parse(value),)
 
     def calc_filter_clause(self):
-        query = []
-        for name, value in self.__dict__.items():
-            if value:
-                operator, val = self._parser_query_value(value)
-                if operator:
-                    query.append(getattr(getattr(self.Model, name), operator)(*val))
-        return query
+        return get_filter_plan(self.Model).calc_filter_clause(self.__dict__)
+
+
+def filter_operator(value: str) -> str:
+    """The name of the operator of a filter value, `eq` without one, such as `in` of `[*]1,2`."""
+    match = sql_operator_pattern.match(value)
+    return sql_operator_map[match.group(1)].strip("_") if match else "eq"
+
+
+_TEXT_OPERATORS = {"like", "not_like"}
+_DATE_PATTERN = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+
+
+def _is_day(value: Any) -> bool:
+    return isinstance(value, datetime.date) and not isinstance(value, datetime.datetime)
+
+
+def _day_start(value: Any) -> Any:
+    return datetime.datetime.combine(value, datetime.time.min) if _is_day(value) else value
+
+
+def _day_end(value: Any) -> Any:
+    """The start of the next day, the exclusive end of the day."""
+    return _day_start(value + datetime.timedelta(days=1)) if _is_day(value) else value
+
+
+def filter_value_type(annotation: Any, column: Any) -> Any:
+    """
+    The python type of the filter values of a field: its annotation without `Optional`/`Annotated`,
+    `uuid.UUID` for a `GUID` column, the `python_type` of the column when the annotation is not a type.
+    """
+    if isinstance(column.type, GUID):
+        return uuid.UUID
+    if get_origin(annotation) is Annotated:
+        annotation = get_args(annotation)[0]
+    args = [arg for arg in get_args(annotation) if arg is not type(None)]
+    if get_origin(annotation) is Union and len(args) == 1:
+        annotation = args[0]
+    if isinstance(annotation, type):
+        return annotation
+    try:
+        return column.type.python_type
+    except NotImplementedError:
+        return str
+
+
+class FilterField:
+    """
+    A filterable field of a `FilterPlan`, its column, the parser of its values and whether it is text.
+    The values are parsed to the python type of the field, they are bound with the SQL type of the column
+    and compared to the column as is, never through a cast or a function of the column, so its index is used.
+    A date given to a datetime field is the whole day, `[=]2023-11-01` is `>= 2023-11-01 00:00` and
+    `< 2023-11-02 00:00`.
+    """
+
+    def __init__(self, name: str, column: Any, annotation: Any, primary_key: bool = False):
+        self.name = name
+        self.column = column
+        self.primary_key = primary_key
+        self.type = filter_value_type(annotation, column.expression)
+        # `EmailStr` is not a subclass of `str`, it is a string column as for `get_sqlalchemy_type`.
+        self.text = issubclass(self.type, str) or self.type is EmailStr
+        self.full_text = bool(column.expression.info.get("full_text"))
+        # The values of the exact and range operators, the patterns of `LIKE` are given as is.
+        self.parse: Callable[[str], Any] = str
+        if self.type is not str:
+            adapter = get_type_adapter(self.type)
+            self.parse = adapter.validate_python
+            if issubclass(self.type, SecretStr):
+                self.parse = lambda value: adapter.validate_python(value).get_secret_value()
+            elif issubclass(self.type, datetime.datetime):
+                self.parse = lambda value: (datetime.date.fromisoformat(value) if _DATE_PATTERN.match(value)
+                                            else adapter.validate_python(value))
+
+    def clause(self, value: str):
+        try:
+            operator, val = Selector._parser_query_value(value, python_type_parse=self.parse)
+        except (ValueError, TypeError):  # ValidationError included
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Invalid value of {self.name}")
+        if operator is None:
+            return None
+        if operator == "full_text":
+            if not self.full_text:
+                raise HTTPException(
+                    status_code=status.HTTP_400_BAD_REQUEST, detail=f"Field is not full-text searchable: {self.name}"
+                )
+            return FullTextMatch(self.column.expression, *val)
+        if operator in _TEXT_OPERATORS and not self.text:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Field is not text: {self.name}")
+        if any(_is_day(v) for v in (val[0] if operator in ("in_", "not_in") else val)):
+            return self._day_clause(operator, val)
+        if operator in ("in_", "not_in"):
+            return in_values(self.column, val[0], negate=operator == "not_in")
+        return getattr(self.column, operator)(*val)
+
+    def _day_clause(self, operator: str, val: tuple):
+        """The clause of dates on a datetime column, as ranges of the column."""
+        column = self.column
+        if operator == "__eq__":
+            return and_(column >= _day_start(val[0]), column < _day_end(val[0]))
+        if operator == "__ne__":
+            return or_(column < _day_start(val[0]), column >= _day_end(val[0]))
+        if operator in ("__lt__", "__ge__"):
+            return getattr(column, operator)(_day_start(val[0]))
+        if operator == "__le__":
+            return column < _day_end(val[0]) if _is_day(val[0]) else column <= val[0]
+        if operator == "__gt__":
+            return column >= _day_end(val[0]) if _is_day(val[0]) else column > val[0]
+        if operator == "between":
+            start, end = val
+            return and_(column >= _day_start(start), column < _day_end(end) if _is_day(end) else column <= end)
+        clauses = [self._day_clause("__eq__", (v,)) if _is_day(v) else column == v for v in val[0]]
+        return or_(*clauses) if operator == "in_" else not_(or_(*clauses))
+
+
+class FilterPlan:
+    """
+    The filters of a model, built once from its `model_fields`: the column of each field is resolved,
+    its values are parsed to the type of the field and the operators are checked against it.
+    The clauses are always in the order of the fields and the values are bound parameters, a filter
+    on the same fields and operators is the same statement for the compiled cache of SQLAlchemy.
+    """
+
+    def __init__(self, model: Type[SQLModel]):
+        self.Model = model
+        columns = inspect(model).column_attrs
+        self.fields: Dict[str, FilterField] = {
+            name: FilterField(name, getattr(model, name), info.annotation, bool(info.primary_key))
+            for name, info in model.model_fields.items() if name in columns
+        }
+
+    def calc_filter_clause(self, values: Dict[str, Any]) -> list:
+        clauses = []
+        for name, field in self.fields.items():
+            value = values.get(name)
+            if value is None or value == "":
+                continue
+            clause = field.clause(value if isinstance(value, str) else str(value))
+            if clause is not None:
+                clauses.append(clause)
+        return clauses
+
+
+@lru_cache(maxsize=None)
+def get_filter_plan(model: Type[SQLModel]) -> FilterPlan:
+    return FilterPlan(model)
 
 
 class Paginator:
+    """
+    Paging parameters of the list routes.
+
+    `mode="offset"` pages with LIMIT/OFFSET (default). `mode="cursor"` pages with a keyset predicate on the
+    `order_by` columns plus the primary key and returns an opaque `next_cursor`; a request can also switch
+    to cursor paging by passing `cursor` (an empty value fetches the first page).
+
+    `count_strategy` overrides the `CountStrategy` of the crud for this route.
+    """
 
-    def __init__(self, page_size_max: int = None, page_size_default: int = 10):
+    def __init__(
+            self,
+            page_size_max: int = None,
+            page_size_default: int = 10,
+            mode: Literal["offset", "cursor"] = "offset",
+            count_strategy: Optional[CountStrategy] = None,
+    ):
         self.page_size_max = page_size_max
         self.page_size_default = page_size_default
+        self.mode = mode
+        self.count_strategy = count_strategy
 
     def __call__(
             self,
@@ -110,15 +341,21 @@ class Paginator:
             page_size: Union[int] = Query(None),
             show_total: bool = Query(True),
             order_by: OrderByListDepend = None,
-
+            cursor: Optional[str] = Query(None, description="Cursor of the next page, returned as `next_cursor`"),
     ):
-        self.page = page if page and page > 0 else self.page_size_default
-        self.page_size = page_size if page_size and page_size > 0 else self.page_size_default
+        # A new instance per request, the dependency instance is shared by all requests of the route.
+        paginator = copy.copy(self)
+        paginator.page = page if page and page > 0 else self.page_size_default
+        paginator.page_size = page_size if page_size and page_size > 0 else self.page_size_default
         if self.page_size_default:
-            self.page_size = min(self.page_size, self.page_size_default)
-        self.show_total = show_total
-        self.order_by = order_by
-        return self
+            paginator.page_size = min(paginator.page_size, self.page_size_default)
+        paginator.show_total = show_total
+        paginator.order_by = order_by
+        paginator.cursor = cursor or None
+        paginator.cursor_mode = self.mode == "cursor" or cursor is not None
+        paginator.next_cursor = None
+        paginator.total_strategy = None
+        return paginator
 
     def calc_ordering(self):
         order = []
@@ -129,3 +366,16 @@ class Paginator:
                 order.append(ob)
 
         return order
+
+    def calc_keyset_ordering(self, model: Type[SQLModel], pk_name: str) -> List[Tuple[str, bool]]:
+        """Return the keyset columns as `(name, descending)`, the primary key is appended as the tie breaker."""
+        keyset = []
+        for ob in self.order_by:
+            name, descending = (ob[1:], True) if ob.startswith("-") else (ob, False)
+            if name not in model.model_fields:
+                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Unknown order_by field: {name}")
+            keyset.append((name, descending))
+            if name == pk_name:  # unique, the columns after it never decide the order
+                return keyset
+        keyset.append((pk_name, keyset[-1][1] if keyset else False))
+        return keyset
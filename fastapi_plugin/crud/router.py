@@ -3,13 +3,17 @@
 # @Author   : zhangzhanqi
 # @FILE     : router.py
 # @Time     : 2023/10/12 9:48
-from typing import List, Annotated, Type
+from typing import List, Annotated, Type, Optional, Literal, Dict, Any, Callable, Awaitable, Sequence
 
-from fastapi import APIRouter, Body, Path, Depends
+from fastapi import APIRouter, Body, Path, Depends, Header, HTTPException, Query, status
 from fastapi.requests import Request
-from pydantic import BaseModel
+from fastapi.responses import StreamingResponse, Response
+from sqlalchemy.exc import SQLAlchemyError
+from pydantic import BaseModel, ValidationError
 
-from .parser import RequiredPrimaryKeyListDepend, Paginator, Selector
+from .parser import RequiredPrimaryKeyListDepend, Paginator, Selector, FieldsDepend, OrderByListDepend, \
+    get_type_adapter
+from .sqlmodel import LoaderStrategy
 from .utils import sqlmodel_to_selector
 
 try:
@@ -19,6 +23,14 @@ except ImportError:
 from ..common.responses import GenericData, DataResponse
 
 
+def etag_matches(if_none_match: Optional[str], etag: Optional[str]) -> bool:
+    """The weak comparison of `If-None-Match`."""
+    if not if_none_match or not etag:
+        return False
+    tags = {tag.strip()[2:] if tag.strip().startswith("W/") else tag.strip() for tag in if_none_match.split(",")}
+    return "*" in tags or etag in tags
+
+
 class CrudRouter:
 
     def __init__(
@@ -47,7 +59,11 @@ class CrudRouter:
                 request: Request,
                 objs: List[cls.crud.CreateModel] = Body(...),
         ):
+            accepted = len(objs)
             objs: List[cls.crud.ReadModel] = await cls.crud.create_items(items=objs, request=request)
+            if cls.crud.write_behind is not None and not cls.crud.write_behind_durable:
+                # Queued, not written yet.
+                return DataResponse(data=ItemsData(items=[], total=accepted), status_code=status.HTTP_202_ACCEPTED)
             return DataResponse(data=ItemsData(
                 items=objs,
                 total=len(objs)
@@ -57,10 +73,20 @@ class CrudRouter:
 
     def read_object_router(
             cls,
+            paginator: Optional[Paginator] = None,
+            loaders: Optional[Dict[str, LoaderStrategy]] = None,
+            explain_requires: Optional[Callable[[Request], Awaitable[Any]]] = None,
     ) -> APIRouter:
+        """`explain_requires` enables `?explain=1` of the list route, the plan of the database for the page
+        instead of the page. It is awaited with the request and raises to refuse it, `auth.requires(roles="admin")`
+        for example."""
         class ItemsData(BaseModel):
             items: List[cls.crud.ReadModel]
             total: int
+            total_strategy: Optional[str] = None
+            next_cursor: Optional[str] = None
+
+        paginator_depend = paginator or Paginator()
 
         router = APIRouter(prefix=f"/{cls.crud.name}", tags=[cls.crud.name])
 
@@ -72,13 +98,40 @@ class CrudRouter:
         async def __get_objects(
                 request: Request,
                 selector: Annotated[cls.Selector, Depends(cls.Selector())],
-                paginator: Annotated[Paginator, Depends(Paginator())]
+                paginator: Annotated[Paginator, Depends(paginator_depend)],
+                fields: FieldsDepend,
+                if_none_match: Optional[str] = Header(None),
+                explain: bool = Query(False, description="The plan of the database for the page, admin only"),
         ):
-            objs, total = await cls.crud.read_items(request=request, selector=selector, paginator=paginator)
-            return DataResponse(data={
+            cls.crud.use_replica()
+            cls.crud.guard_read(selector, paginator)
+            if explain:
+                if explain_requires is None:
+                    raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Explain is not enabled")
+                await explain_requires(request)
+                plan = await cls.crud.explain_items(
+                    selector=selector, paginator=paginator, fields=fields, loaders=loaders
+                )
+                return DataResponse(data=plan)
+            objs, total = await cls.crud.read_items(
+                request=request, selector=selector, paginator=paginator, fields=fields, loaders=loaders
+            )
+            data = {
                 "items": objs,
                 "total": total
-            })
+            }
+            if paginator.total_strategy:
+                data["total_strategy"] = paginator.total_strategy
+            if paginator.cursor_mode:
+                data["next_cursor"] = paginator.next_cursor
+            headers = None
+            if cls.crud.etag_field:
+                # A 304 saves the body only, the page is read or taken from `result_cache` as without ETag.
+                etag = cls.crud.page_etag(data)
+                if etag_matches(if_none_match, etag):
+                    return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+                headers = {"ETag": etag}
+            return DataResponse(data=data, headers=headers)
 
         @router.get(
             f"/{{{cls.crud.pk_name}}}",
@@ -87,10 +140,149 @@ class CrudRouter:
         )
         async def __get_object(
                 request: Request,
-                primary_key: cls.crud.pk_field.annotation = Path(..., alias=cls.crud.pk_name)
+                fields: FieldsDepend,
+                primary_key: cls.crud.pk_field.annotation = Path(..., alias=cls.crud.pk_name),
+                if_none_match: Optional[str] = Header(None),
         ):
-            obj = await cls.crud.read_item_by_primary_key(primary_key=primary_key, request=request)
-            return DataResponse(data=obj)
+            cls.crud.use_replica()
+            headers = None
+            if cls.crud.etag_field:
+                etag = await cls.crud.read_item_etag(primary_key, fields=fields)
+                if etag_matches(if_none_match, etag):
+                    return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+                headers = {"ETag": etag} if etag else None
+            obj = await cls.crud.read_item_by_primary_key(
+                primary_key=primary_key, request=request, fields=fields, loaders=loaders
+            )
+            return DataResponse(data=obj, headers=headers)
+
+        return router
+
+    def export_object_router(
+            cls,
+            batch_size: int = 1000,
+    ) -> APIRouter:
+        media_types = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+        router = APIRouter(prefix=f"/{cls.crud.name}", tags=[cls.crud.name])
+
+        # Two path segments below the prefix, it never collides with `/{primary_key}`.
+        @router.get(
+            "/export/{format}",
+            response_class=StreamingResponse,
+            name=f'export {cls.crud.name} all',
+        )
+        async def __export_objects(
+                selector: Annotated[cls.Selector, Depends(cls.Selector())],
+                order_by: OrderByListDepend,
+                fields: FieldsDepend,
+                format: Literal["ndjson", "csv"] = Path(...),
+        ):
+            content = cls.crud.export_items(
+                selector=selector, order_by=order_by, fields=fields, format=format, batch_size=batch_size
+            )
+            return StreamingResponse(
+                content,
+                media_type=media_types[format],
+                headers={"Content-Disposition": f'attachment; filename="{cls.crud.name}.{format}"'},
+            )
+
+        return router
+
+    def usage_object_router(
+            cls,
+            dependencies: Optional[Sequence[Any]] = None,
+            slow: float = 0.1,
+    ) -> APIRouter:
+        """The report of the list reads of a crud built with `usage_stats=True`, with the indexes missing for
+        the reads of `slow` seconds or more. An admin route, `dependencies=[Depends(auth.current_user(...))]`."""
+
+        router = APIRouter(prefix=f"/{cls.crud.name}", tags=[cls.crud.name], dependencies=dependencies)
+
+        # Two path segments below the prefix, it never collides with `/{primary_key}`.
+        @router.get(
+            "/usage/indexes",
+            response_model=GenericData[Dict[str, Any]],
+            name=f'usage of {cls.crud.name}',
+        )
+        async def __usage_objects():
+            return DataResponse(data=cls.crud.usage_report(slow=slow))
+
+        @router.delete(
+            "/usage/indexes",
+            response_model=GenericData[Dict[str, Any]],
+            name=f'clear usage of {cls.crud.name}',
+        )
+        async def __clear_usage_objects():
+            report = cls.crud.usage_report(slow=slow)
+            cls.crud.usage.clear()
+            return DataResponse(data=report)
+
+        return router
+
+    def upsert_object_router(
+            cls,
+    ) -> APIRouter:
+        class ItemsData(BaseModel):
+            items: List[cls.crud.ReadModel]
+            total: int
+
+        router = APIRouter(prefix=f"/{cls.crud.name}", tags=[cls.crud.name])
+
+        @router.put(
+            "",
+            response_model=GenericData[ItemsData],
+            name=f'upsert {cls.crud.name}',
+        )
+        async def __upsert_object(
+                request: Request,
+                objs: List[cls.crud.UpsertModel] = Body(...),
+                on: Optional[str] = Query(None, description="Comma separated fields of the unique key of conflicts"),
+        ):
+            conflict = [name for name in on.split(",") if name] if on else None
+            objs = await cls.crud.upsert_items(request=request, items=objs, conflict=conflict)
+            return DataResponse(data=ItemsData(
+                items=objs,
+                total=len(objs)
+            ))
+
+        return router
+
+    def aggregate_object_router(
+            cls,
+            limit: int = 1000,
+    ) -> APIRouter:
+        class AggregateData(BaseModel):
+            columns: List[str]
+            rows: List[List[Any]]
+
+        router = APIRouter(tags=[cls.crud.name])
+
+        # Not below the prefix of the model, it would collide with `/{primary_key}`.
+        @router.get(
+            f"/aggregate/{cls.crud.name}",
+            response_model=GenericData[AggregateData],
+            name=f'aggregate {cls.crud.name}',
+        )
+        async def __aggregate_objects(
+                request: Request,
+                selector: Annotated[cls.Selector, Depends(cls.Selector())],
+                group_by: Optional[str] = Query(
+                    None, description="Comma separated fields, `field:minute|hour|day|week|month|year` for time buckets"
+                ),
+                agg: Optional[str] = Query(
+                    "count", description="Comma separated aggregates, `count` or `count|sum|avg|min|max:field`"
+                ),
+        ):
+            cls.crud.use_replica()
+            columns, rows = await cls.crud.aggregate_items(
+                request=request,
+                selector=selector,
+                group_by=[spec for spec in (group_by or "").split(",") if spec],
+                aggregates=[spec for spec in (agg or "count").split(",") if spec],
+                limit=limit,
+            )
+            return DataResponse(data=AggregateData(columns=columns, rows=rows))
 
         return router
 
@@ -109,7 +301,20 @@ class CrudRouter:
                 request: Request,
                 primary_key: cls.crud.pk_field.annotation = Path(..., alias=cls.crud.pk_name),
                 obj_update: cls.crud.UpdateModel = Body(...),
+                if_match: Optional[str] = Header(None),
         ):
+            if if_match and cls.crud.etag_field:
+                # The version is a condition of the write itself, a concurrent write of the same version matches no row.
+                obj = await cls.crud.update_items(
+                    primary_key=[primary_key], item=obj_update, request=request,
+                    query=cls.crud.etag_condition(if_match),
+                )
+                if not obj:
+                    # No row matched the condition: a missing item is a 404, only a changed one fails it.
+                    if await cls.crud.read_item_etag(primary_key) is None:
+                        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Not found")
+                    raise HTTPException(status_code=status.HTTP_412_PRECONDITION_FAILED, detail="ETag mismatch")
+                return DataResponse(data=obj)
             obj = await cls.crud.update_items(primary_key=[primary_key], item=obj_update, request=request)
             return DataResponse(data=obj)
 
@@ -142,7 +347,18 @@ class CrudRouter:
         async def __delete_object(
                 request: Request,
                 primary_key: cls.crud.pk_field.annotation = Path(..., alias=cls.crud.pk_name),
+                if_match: Optional[str] = Header(None),
         ):
+            if if_match and cls.crud.etag_field:
+                objs = await cls.crud.delete_items(
+                    request, primary_key=[primary_key], query=cls.crud.etag_condition(if_match)
+                )
+                if not objs:
+                    # No row matched the condition: a missing item is a 404, only a changed one fails it.
+                    if await cls.crud.read_item_etag(primary_key) is None:
+                        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Not found")
+                    raise HTTPException(status_code=status.HTTP_412_PRECONDITION_FAILED, detail="ETag mismatch")
+                return DataResponse(data=objs)
             objs = await cls.crud.delete_items(request, primary_key=[primary_key])
             return DataResponse(data=objs)
 
@@ -159,3 +375,94 @@ class CrudRouter:
             return DataResponse(data=objs)
 
         return router
+
+
+class BatchOperation(BaseModel):
+    op: Literal["create", "read", "update", "delete"]
+    model: str
+    primary_key: Optional[List[Any]] = None
+    """The items of read, update and delete."""
+    data: Any = None
+    """The list of items of create, the values of update."""
+    fields: Optional[List[str]] = None
+
+
+class BatchResult(BaseModel):
+    op: str
+    model: str
+    data: Any = None
+
+
+def batch_router(*cruds: _SQLAlchemyCrud, path: str = "/batch", tags: Optional[List[str]] = None) -> APIRouter:
+    """
+    A route running an ordered list of operations on the models of `cruds` in the session of the request,
+    they are committed together, once, by the middleware of the database. The first failing operation
+    rolls back all of them.
+    """
+    assert cruds, "cruds is empty"
+    assert not any(hasattr(crud, "shards") for crud in cruds), "A sharded crud has no transaction of its own"
+    assert len({id(crud.db) for crud in cruds}) == 1, "The cruds of a batch must share the database"
+    db = cruds[0].db
+    models = {crud.name: crud for crud in cruds}
+
+    router = APIRouter(tags=tags or ["batch"])
+
+    async def rollback() -> None:
+        # The middleware commits the session of a handled error response, roll back first.
+        await db.async_run_sync(lambda session: session.rollback())
+
+    async def run(request: Request, crud: _SQLAlchemyCrud, operation: BatchOperation) -> Any:
+        if operation.op == "create":
+            items = get_type_adapter(List[crud.CreateModel]).validate_python(operation.data or [])
+            return await crud.create_items(request=request, items=items, write_behind=False)
+        if not operation.primary_key:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="primary_key is required")
+        primary_key = get_type_adapter(List[crud.pk_field.annotation]).validate_python(operation.primary_key)
+        if operation.op == "read":
+            return await crud.read_items_by_primary_key(
+                request=request, primary_key=primary_key, fields=operation.fields
+            )
+        if operation.op == "update":
+            item = crud.UpdateModel.model_validate(operation.data or {})
+            return await crud.update_items(request=request, primary_key=primary_key, item=item)
+        return await crud.delete_items(request, primary_key=primary_key)
+
+    @router.post(
+        path,
+        response_model=GenericData[List[BatchResult]],
+        name=f'batch {",".join(models)}',
+    )
+    async def __batch(
+            request: Request,
+            operations: List[BatchOperation] = Body(...),
+    ):
+        results = []
+        for index, operation in enumerate(operations):
+            crud = models.get(operation.model)
+            if crud is None:
+                await rollback()
+                raise HTTPException(
+                    status_code=status.HTTP_400_BAD_REQUEST,
+                    detail={"index": index, "detail": f"Unknown model: {operation.model}"},
+                )
+            try:
+                data = await run(request, crud, operation)
+            except HTTPException as exc:
+                await rollback()
+                raise HTTPException(status_code=exc.status_code, detail={"index": index, "detail": exc.detail})
+            except ValidationError as exc:
+                await rollback()
+                raise HTTPException(
+                    status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                    detail={"index": index, "detail": exc.errors(include_url=False)},
+                )
+            except SQLAlchemyError as exc:
+                await rollback()
+                raise HTTPException(
+                    status_code=status.HTTP_400_BAD_REQUEST,
+                    detail={"index": index, "detail": str(getattr(exc, "orig", None) or exc)},
+                )
+            results.append(BatchResult(op=operation.op, model=operation.model, data=data))
+        return DataResponse(data=results)
+
+    return router
@@ -85,6 +85,25 @@ class AbcAsyncDatabase(metaclass=abc.ABCMeta):  # noqa: B024
                 func = functools.partial(to_thread, func)
             setattr(self, f"async_{func_name}", func)
 
+    def use_replica(self, enabled: bool = True) -> None:
+        """Send the reads of the session of the current context to the read replicas, or back to the primary.
+        Without `read_engines` it changes nothing. The reads of a session which has written stay on the primary,
+        a single statement can choose with `.execution_options(replica=True/False)`.
+        Example:
+            ```Python
+            @app.get('/users')
+            async def list_users():
+                db.use_replica()
+                return (await db.async_scalars(select(User))).all()
+            ```
+        """
+        self.session.info["replica"] = enabled
+
+    def read_engine(self) -> Union[Engine, AsyncEngine]:
+        """The engine of a read on a connection of its own, a read replica if there are some."""
+        replicas = getattr(self, "replicas", None)
+        return replicas.choose() if replicas is not None else self.engine
+
     async def asgi_dispatch(self, request, call_next):
         """
         This method has been deprecated and is not recommended. Please use the `asgi_middleware` method instead.
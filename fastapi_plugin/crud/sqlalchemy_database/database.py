@@ -1,16 +1,22 @@
 import functools
+import itertools
+import time
 from contextvars import ContextVar
 from typing import (
     Any,
     AsyncGenerator,
     Callable,
+    Dict,
     Generator,
+    Literal,
     Mapping,
     Optional,
+    Sequence,
     TypeVar,
     Union,
 )
 
+from sqlalchemy import event
 from sqlalchemy.engine import URL, Connection
 from sqlalchemy.ext.asyncio import (
     AsyncEngine,
@@ -29,6 +35,83 @@ _P = ParamSpec("_P")
 _T = TypeVar("_T")
 _R = TypeVar("_R")
 
+ReplicaStrategy = Literal["round_robin", "latency"]
+
+
+class ReadReplicas:
+    """The read engines of a database and the choice of one of them for a read.
+
+    `round_robin` takes them in turn, `latency` takes the one with the lowest moving average
+    of the statement latency, measured on every statement the engine runs. One read in `probe_every`
+    goes to the engines in turn instead, so the latency of a replica that was slow is measured again.
+    """
+
+    def __init__(
+            self,
+            engines: Sequence[Union[Engine, AsyncEngine]],
+            strategy: ReplicaStrategy = "round_robin",
+            probe_every: int = 20,
+    ):
+        assert engines, "engines is empty"
+        self.engines: list = list(engines)
+        self.strategy = strategy
+        self.probe_every = probe_every
+        self.latency: Dict[int, float] = {id(engine): 0.0 for engine in self.engines}
+        """The moving average of the statement latency of each engine, in seconds, by `id` of the engine."""
+        self._counter = itertools.count()
+        if strategy == "latency":
+            for engine in self.engines:
+                sync_engine = getattr(engine, "sync_engine", engine)
+                event.listen(sync_engine, "before_cursor_execute", self._before_execute)
+                event.listen(sync_engine, "after_cursor_execute", functools.partial(self._after_execute, id(engine)))
+
+    @staticmethod
+    def _before_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+        conn.info["replica_started"] = time.perf_counter()
+
+    def _after_execute(self, key: int, conn, cursor, statement, parameters, context, executemany) -> None:
+        started = conn.info.pop("replica_started", None)
+        if started is not None:
+            self.latency[key] = 0.8 * self.latency[key] + 0.2 * (time.perf_counter() - started)
+
+    def choose(self) -> Union[Engine, AsyncEngine]:
+        count = next(self._counter)
+        if self.strategy == "latency":
+            if count % self.probe_every:
+                return min(self.engines, key=lambda engine: self.latency[id(engine)])
+            count //= self.probe_every
+        return self.engines[count % len(self.engines)]
+
+
+class RoutingSession(Session):
+    """A session sending the reads to the `replicas` and everything else to the primary bind.
+
+    A select goes to a replica when the session is told to (`session.info["replica"]`, see `use_replica`)
+    or the statement is (`.execution_options(replica=True)`); `replica=False` keeps a statement on the primary.
+    Once the session has flushed or run a write, its reads stay on the primary to see the writes.
+    """
+
+    def __init__(self, *args, replicas: Optional[ReadReplicas] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.replicas = replicas
+
+    def get_bind(self, mapper=None, *, clause=None, **kw):
+        if self.replicas is not None and self._read_replica(clause):
+            engine = self.replicas.choose()
+            return getattr(engine, "sync_engine", engine)
+        return super().get_bind(mapper, clause=clause, **kw)
+
+    def _read_replica(self, clause) -> bool:
+        if self._flushing or getattr(clause, "is_dml", False):
+            self.info["replica_wrote"] = True
+            return False
+        if not getattr(clause, "is_select", False):
+            return False
+        option = clause.get_execution_options().get("replica")
+        if option is False or self.info.get("replica_wrote"):
+            return False
+        return bool(option or self.info.get("replica"))
+
 
 class AsyncDatabase(AbcAsyncDatabase):
     """`sqlalchemy` asynchronous database client"""
@@ -37,6 +120,8 @@ class AsyncDatabase(AbcAsyncDatabase):
         self,
         engine: AsyncEngine,
         commit_on_exit: bool = True,
+        read_engines: Sequence[AsyncEngine] = (),
+        replica_strategy: ReplicaStrategy = "round_robin",
         **session_options,
     ):
         """
@@ -44,6 +129,8 @@ class AsyncDatabase(AbcAsyncDatabase):
         Args:
             engine: Asynchronous Engine
             commit_on_exit: Whether to commit the session when the context manager or session generator exits.
+            read_engines: Asynchronous engines of the read replicas, see `use_replica`.
+            replica_strategy: How a read replica is chosen, `round_robin` or `latency`.
             **session_options: The default `session` initialization parameters
         """
         self.engine: AsyncEngine = engine
@@ -58,6 +145,11 @@ class AsyncDatabase(AbcAsyncDatabase):
         self.commit_on_exit: bool = commit_on_exit
         """Whether to commit the session when the context manager or session generator exits."""
         session_options.setdefault("class_", AsyncSession)
+        self.replicas: Optional[ReadReplicas] = ReadReplicas(read_engines, replica_strategy) if read_engines else None
+        """The read replicas, None without `read_engines`."""
+        if self.replicas is not None:
+            session_options.setdefault("sync_session_class", RoutingSession)
+            session_options.setdefault("replicas", self.replicas)
         self.session_maker: Callable[..., AsyncSession] = sessionmaker(self.engine, **session_options)
         """`sqlalchemy` session factory function
 
@@ -109,7 +201,14 @@ class AsyncDatabase(AbcAsyncDatabase):
 
     @classmethod
     def create(
-        cls, url: Union[str, URL], *, commit_on_exit: bool = True, session_options: Mapping[str, Any] = None, **kwargs
+        cls,
+        url: Union[str, URL],
+        *,
+        commit_on_exit: bool = True,
+        session_options: Mapping[str, Any] = None,
+        read_urls: Sequence[Union[str, URL]] = (),
+        replica_strategy: ReplicaStrategy = "round_robin",
+        **kwargs,
     ) -> "AsyncDatabase":
         """
         Initialize the client with a database connection string
@@ -117,15 +216,21 @@ class AsyncDatabase(AbcAsyncDatabase):
             url: Asynchronous database connection string
             commit_on_exit: Whether to commit the session when the context manager or session generator exits.
             session_options: The default `session` initialization parameters
-            **kwargs: Asynchronous engine initialization parameters
+            read_urls: Asynchronous database connection strings of the read replicas
+            replica_strategy: How a read replica is chosen, `round_robin` or `latency`.
+            **kwargs: Asynchronous engine initialization parameters, of the read replicas too
 
         Returns:
             Return the client instance.
         """
         kwargs.setdefault("future", True)
         engine = create_async_engine(url, **kwargs)
+        read_engines = [create_async_engine(read_url, **kwargs) for read_url in read_urls]
         session_options = session_options or {}
-        return cls(engine, commit_on_exit=commit_on_exit, **session_options)
+        return cls(
+            engine, commit_on_exit=commit_on_exit, read_engines=read_engines, replica_strategy=replica_strategy,
+            **session_options,
+        )
 
     async def session_generator(self) -> AsyncGenerator[AsyncSession, Any]:
         """AsyncSession Generator, available for FastAPI dependencies.
@@ -193,9 +298,20 @@ class AsyncDatabase(AbcAsyncDatabase):
 class Database(AbcAsyncDatabase):
     """`sqlalchemy` synchronous database client"""
 
-    def __init__(self, engine: Engine, commit_on_exit: bool = True, **session_options):
+    def __init__(
+        self,
+        engine: Engine,
+        commit_on_exit: bool = True,
+        read_engines: Sequence[Engine] = (),
+        replica_strategy: ReplicaStrategy = "round_robin",
+        **session_options,
+    ):
         self.engine: Engine = engine
         self.commit_on_exit: bool = commit_on_exit
+        self.replicas: Optional[ReadReplicas] = ReadReplicas(read_engines, replica_strategy) if read_engines else None
+        if self.replicas is not None:
+            session_options.setdefault("class_", RoutingSession)
+            session_options.setdefault("replicas", self.replicas)
         session_options.setdefault("class_", Session)
         self.session_maker: Callable[..., Session] = sessionmaker(self.engine, **session_options)
         self._session_scope: ContextVar[Union[str, Session, None]] = ContextVar(f"_session_context_var_{id(self)}", default=None)
@@ -216,12 +332,20 @@ class Database(AbcAsyncDatabase):
 
     @classmethod
     def create(
-        cls, url: Union[str, URL], *, commit_on_exit: bool = True, session_options: Optional[Mapping[str, Any]] = None, **kwargs
+        cls,
+        url: Union[str, URL],
+        *,
+        commit_on_exit: bool = True,
+        session_options: Optional[Mapping[str, Any]] = None,
+        read_urls: Sequence[Union[str, URL]] = (),
+        replica_strategy: ReplicaStrategy = "round_robin",
+        **kwargs,
     ) -> "Database":
         kwargs.setdefault("future", True)
         engine = create_engine(url, **kwargs)
+        read_engines = [create_engine(read_url, **kwargs) for read_url in read_urls]
         session_options = session_options or {}
-        return cls(engine, **session_options)
+        return cls(engine, read_engines=read_engines, replica_strategy=replica_strategy, **session_options)
 
     def session_generator(self) -> Generator[Session, Any, None]:
         if self.scoped:
@@ -135,4 +135,5 @@ from .sql.sqltypes import AutoString as AutoString
 # Export SQLModel specifics (equivalent to Pydantic)
 from .main import SQLModel as SQLModel
 from .main import Field as Field
+from .main import LoaderStrategy as LoaderStrategy
 from .main import Relationship as Relationship
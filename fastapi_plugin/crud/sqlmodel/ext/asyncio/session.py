@@ -43,8 +43,9 @@ class AsyncSession(_AsyncSession):
                 for key, b in binds.items()
             }
 
+        sync_session_class = kw.pop("sync_session_class", None) or Session
         self.sync_session = self._proxied = self._assign_proxied(  # type: ignore
-            Session(bind=bind, binds=binds, **kw)  # type: ignore
+            sync_session_class(bind=bind, binds=binds, **kw)  # type: ignore
         )
 
     async def exec(
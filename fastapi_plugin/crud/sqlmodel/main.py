@@ -17,6 +17,7 @@ from typing import (
     Dict,
     ForwardRef,
     List,
+    Literal,
     Mapping,
     Optional,
     Sequence,
@@ -86,6 +87,7 @@ class FieldInfo(PydanticFieldInfo):
         sa_column_args = kwargs.pop("sa_column_args", PydanticUndefined)
         sa_column_kwargs = kwargs.pop("sa_column_kwargs", PydanticUndefined)
         mode = kwargs.pop("mode", "crud")
+        full_text = kwargs.pop("full_text", False)
         if sa_column is not PydanticUndefined:
             if sa_column_args is not PydanticUndefined:
                 raise RuntimeError(
@@ -107,6 +109,12 @@ class FieldInfo(PydanticFieldInfo):
         self.sa_column_args = sa_column_args
         self.sa_column_kwargs = sa_column_kwargs
         self.mode = mode
+        self.full_text = full_text
+
+
+# Loader strategies of the relationships in the queries of the crud: lazy "select", "selectin",
+# "joined", "subquery", "raise" on access, or "noload".
+LoaderStrategy = Literal["select", "selectin", "joined", "subquery", "raise", "noload"]
 
 
 class RelationshipInfo(Representation):
@@ -118,6 +126,7 @@ class RelationshipInfo(Representation):
         sa_relationship: Optional[RelationshipProperty] = None,  # type: ignore
         sa_relationship_args: Optional[Sequence[Any]] = None,
         sa_relationship_kwargs: Optional[Mapping[str, Any]] = None,
+        loader: Optional[LoaderStrategy] = None,
     ) -> None:
         if sa_relationship is not None:
             if sa_relationship_args is not None:
@@ -135,6 +144,7 @@ class RelationshipInfo(Representation):
         self.sa_relationship = sa_relationship
         self.sa_relationship_args = sa_relationship_args
         self.sa_relationship_kwargs = sa_relationship_kwargs
+        self.loader = loader
 
 
 def Field(
@@ -173,6 +183,7 @@ def Field(
         Mapping[str, Any], PydanticUndefinedType
     ] = PydanticUndefined,
     mode: Optional[str] = "crud",
+    full_text: Union[bool, str] = False,
     schema_extra: Optional[Dict[str, Any]] = None,
 ) -> Any:
     current_schema_extra = schema_extra or {}
@@ -234,6 +245,7 @@ def Field(
         sa_column_args=sa_column_args,
         sa_column_kwargs=sa_column_kwargs,
         mode=mode,
+        full_text=full_text,
         **current_schema_extra,
     )
     return field_info
@@ -246,6 +258,7 @@ def Relationship(
     sa_relationship: Optional[RelationshipProperty[Any]] = None,
     sa_relationship_args: Optional[Sequence[Any]] = None,
     sa_relationship_kwargs: Optional[Mapping[str, Any]] = None,
+    loader: Optional[LoaderStrategy] = None,
 ) -> Any:
     relationship_info = RelationshipInfo(
         back_populates=back_populates,
@@ -253,6 +266,7 @@ def Relationship(
         sa_relationship=sa_relationship,
         sa_relationship_args=sa_relationship_args,
         sa_relationship_kwargs=sa_relationship_kwargs,
+        loader=loader,
     )
     return relationship_info
 
@@ -568,6 +582,10 @@ def get_column_from_field(field: FieldInfo) -> Column:  # type: ignore
         "index": index,
         "unique": unique,
     }
+    full_text = getattr(field, "full_text", False)
+    if full_text:
+        # The text search configuration of PostgreSQL, `simple` unless the field names one.
+        kwargs["info"] = {"full_text": "simple" if full_text is True else full_text}
     sa_default: Union[PydanticUndefinedType, Callable[[], Any]] = PydanticUndefined
     if field.default_factory:
         sa_default = field.default_factory
@@ -0,0 +1,120 @@
+# !/usr/bin/env Python3
+# -*- coding: utf-8 -*-
+# @Author   : zhangzhanqi
+# @FILE     : usage.py
+# @Time     : 2023/11/28 15:06
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from sqlalchemy import PrimaryKeyConstraint, Table, UniqueConstraint
+from sqlalchemy.engine import Dialect
+from sqlalchemy.engine.default import DefaultDialect
+
+# The operators an index seeks to, the columns of equality lead the index, a range ends it.
+_EQUALITY = {"eq", "in"}
+_RANGE = {"lt", "le", "gt", "ge", "between", "startswith"}
+SEEK_OPERATORS = frozenset(_EQUALITY | _RANGE)
+"""The operators of the filters an index of their column serves, `filter_operator` names."""
+
+Shape = Tuple[Tuple[Tuple[str, str], ...], Tuple[str, ...]]
+
+
+class QueryUsage:
+    """
+    How often the list reads of a model filter on each combination of columns and operators and sort on each
+    `order_by`, and how long they took. `advise` suggests the composite indexes of the slow combinations
+    that the indexes of the table do not cover. At most `maxsize` combinations are recorded, the reads of
+    the others are only counted in `dropped`.
+    """
+
+    def __init__(self, maxsize: int = 1000):
+        self.maxsize = maxsize
+        self.shapes: Dict[Shape, List[float]] = {}
+        """count, total latency, max latency, by (filters, order_by)"""
+        self.dropped = 0
+
+    def record(self, filters: Sequence[Tuple[str, str]], order_by: Sequence[str], latency: float) -> None:
+        """`filters` are the (column, operator) of a read, `order_by` its columns, `-` prefixed when descending."""
+        shape = (tuple(filters), tuple(order_by))
+        stat = self.shapes.get(shape)
+        if stat is None:
+            if len(self.shapes) >= self.maxsize:
+                self.dropped += 1
+                return
+            stat = self.shapes[shape] = [0, 0.0, 0.0]
+        stat[0] += 1
+        stat[1] += latency
+        stat[2] = max(stat[2], latency)
+
+    def clear(self) -> None:
+        self.shapes.clear()
+        self.dropped = 0
+
+    @staticmethod
+    def index_columns(filters: Sequence[Tuple[str, str]], order_by: Sequence[str]) -> Tuple[List[str], int]:
+        """
+        The columns of the index of a read and how many of them are equalities: the columns compared
+        for equality, then the `order_by` columns, or the column of the first range without `order_by`.
+        The other operators, `!`, `~` and the like, are not served by an index.
+        """
+        columns = list(dict.fromkeys(column for column, op in filters if op in _EQUALITY))
+        equalities = len(columns)
+        ordered = [ob[1:] if ob.startswith("-") else ob for ob in order_by]
+        if ordered:
+            columns += [column for column in dict.fromkeys(ordered) if column not in columns]
+        else:
+            columns += [column for column, op in filters if op in _RANGE and column not in columns][:1]
+        return columns, equalities
+
+    @staticmethod
+    def covering_index(table: Table, columns: Sequence[str], equalities: int) -> Optional[str]:
+        """The name of an index of `table` whose leading columns are `columns`, the equalities in any order."""
+        indexes: List[Tuple[str, List[str]]] = [(index.name, [c.name for c in index.columns])
+                                                for index in table.indexes]
+        for constraint in table.constraints:
+            if isinstance(constraint, PrimaryKeyConstraint):
+                indexes.append((constraint.name or "primary key", [c.name for c in constraint.columns]))
+            elif isinstance(constraint, UniqueConstraint):
+                indexes.append((constraint.name or "unique", [c.name for c in constraint.columns]))
+        for name, index_columns in indexes:
+            if (
+                    len(index_columns) >= len(columns)
+                    and set(index_columns[:equalities]) == set(columns[:equalities])
+                    and index_columns[equalities:len(columns)] == list(columns[equalities:])
+            ):
+                return name
+        return None
+
+    @staticmethod
+    def _create_index(table: Table, columns: Sequence[str], preparer) -> str:
+        name = preparer.quote(f"ix_{table.name}_{'_'.join(columns)}")
+        return f"CREATE INDEX {name} ON {preparer.format_table(table)} ({', '.join(map(preparer.quote, columns))})"
+
+    def advise(self, table: Table, dialect: Optional[Dialect] = None, slow: float = 0.1) -> Dict[str, Any]:
+        """
+        The recorded reads, the slowest first, with the index that serves each one, and the `CREATE INDEX` of
+        the indexes missing for the reads of `slow` seconds or more on average, the index of several reads once.
+        """
+        preparer = (dialect or DefaultDialect()).identifier_preparer
+        shapes, indexes = [], {}
+        for (filters, order_by), (count, total, latency_max) in self.shapes.items():
+            columns, equalities = self.index_columns(filters, order_by)
+            covered_by = self.covering_index(table, columns, equalities) if columns else None
+            shapes.append({
+                "filters": [f"{column} {op}" for column, op in filters], "order_by": list(order_by),
+                "count": count, "latency_avg": total / count, "latency_max": latency_max, "latency_total": total,
+                "index": columns, "covered_by": covered_by,
+            })
+            if columns and covered_by is None and total / count >= slow:
+                advice = indexes.get(tuple(columns))
+                if advice is None:
+                    advice = indexes[tuple(columns)] = {
+                        "columns": columns, "ddl": self._create_index(table, columns, preparer),
+                        "count": 0, "latency_total": 0.0,
+                    }
+                advice["count"] += count
+                advice["latency_total"] += total
+        shapes.sort(key=lambda shape: shape["latency_total"], reverse=True)
+        return {
+            "shapes": shapes, "dropped": self.dropped,
+            "indexes": sorted(indexes.values(), key=lambda advice: advice["latency_total"], reverse=True),
+        }
@@ -3,22 +3,20 @@
 # @Author   : zhangzhanqi
 # @FILE     : utils.py.py
 # @Time     : 2023/10/11 16:11
-from typing import Union, Type, Literal
+import inspect
+from typing import Union, Type, Literal, Optional
 
+from fastapi import Query
 from pydantic import BaseModel, create_model, ConfigDict
-from pydantic_core import PydanticUndefined
 from sqlalchemy.engine import Engine
 from sqlalchemy.ext.asyncio import AsyncEngine
 
-from .parser import Selector
+from .parser import Selector, get_filter_plan
 from .sqlalchemy_database import AsyncDatabase, Database
 from .sqlmodel import SQLModel
 
 SqlalchemyDatabase = Union[Engine, AsyncEngine, Database, AsyncDatabase]
 
-t = PydanticUndefined
-
-
 def get_engine_db(engine: SqlalchemyDatabase) -> Union[Database, AsyncDatabase]:
     if isinstance(engine, (Database, AsyncDatabase)):
         return engine
@@ -44,31 +42,27 @@ def sqlmodel_to_crud(
 def sqlmodel_to_selector(
         base_model: Type[SQLModel],
 ) -> Type[Selector]:
-    imports = []
-    params = []
-    methods = []
-    for name, field_info in base_model.model_fields.items():
-        if field_info.primary_key:
-            params.append(f"{name}: str = Query(None, alias='primary_key', "
-                          f"description='{base_model.__name__} primary_key({name})')")
-            imports.append('from fastapi import Query')
-            methods.append(f"self.{name} = {name}")
-            pass
+    """
+    A Selector of the model, a dependency with an optional `str` query parameter per field of its
+    `FilterPlan`, the primary key as `primary_key`. Every call returns a new Selector of the values.
+    """
+    plan = get_filter_plan(base_model)
+    parameters = [inspect.Parameter("self", inspect.Parameter.POSITIONAL_ONLY)]
+    for name, field in plan.fields.items():
+        if field.primary_key:
+            default = Query(None, alias="primary_key", description=f"{base_model.__name__} primary_key({name})")
         else:
-            params.append(f"{name}: {field_info.annotation.__name__} = {field_info.default or 'None'}")
-            imports.append(f"from {field_info.annotation.__module__} import {field_info.annotation.__name__}")
-            methods.append(f"self.{name} = {name}")
+            default = Query(None)
+        parameters.append(
+            inspect.Parameter(name, inspect.Parameter.KEYWORD_ONLY, default=default, annotation=Optional[str])
+        )
 
-    func = f"""
-{";".join(set(imports))}
-def call(
-    self,
-    {",".join(set(params))}
-):
-    {";".join(set(methods))}
-    return self
-    """
-    exec(func, globals())
+    def call(self, **values):
+        selector = type(self)()
+        selector.__dict__.update(values)
+        return selector
+
+    call.__signature__ = inspect.Signature(parameters)
 
     return type(f'{base_model.__name__}Selector', (Selector,), {
         'Model': base_model,
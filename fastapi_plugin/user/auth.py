@@ -132,6 +132,28 @@ class Auth(_AuthInit):
 
         return current_user_dependency
 
+    def requires(
+            self,
+            roles: Union[str, Sequence[str]] = None,
+            groups: Union[str, Sequence[str]] = None,
+            permissions: Union[str, Sequence[str]] = None,
+    ):
+        """The check of `current_user` as a function of the request, for a route which only checks some requests,
+        such as the `explain_requires` of `CrudRouter.read_object_router`."""
+        async def requires_check(request: Request):
+            token = await self.transport.scheme(request)
+            user, _ = await self._authenticate(
+                request=request,
+                security_scopes=SecurityScopes(),
+                token=token,
+                roles=roles,
+                groups=groups,
+                permissions=permissions,
+            )
+            return user
+
+        return requires_check
+
     async def _authenticate(
             self,
             request: Request,
@@ -249,7 +249,8 @@ class BaseUser(PkMixin, UsernameMixin, PasswordMixin, EmailMixin, CreateTimeMixi
         if permissions:
             permissions_list = [permissions] if isinstance(permissions, str) else list(permissions)
             stmt = stmt.where(self._exists_permissions(permissions_list))
-        return bool(session.scalar(stmt))
+        # A read replica serves the check if the database has some, see `RoutingSession`.
+        return bool(session.scalar(stmt.execution_options(replica=True)))
 
 
 class User(BaseUser, table=True):
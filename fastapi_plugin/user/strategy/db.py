@@ -32,7 +32,7 @@ class DbTokenStore(BaseTokenStore):
         self.db = db
 
     async def read_token(self, token: str) -> Optional[TokenDataSchemaT]:
-        stmt = select(TokenStoreModel).where(TokenStoreModel.token == token)
+        stmt = select(TokenStoreModel).where(TokenStoreModel.token == token).execution_options(replica=True)
         obj: TokenStoreModel = await self.db.async_scalar(stmt)
         if obj is None:
             return None